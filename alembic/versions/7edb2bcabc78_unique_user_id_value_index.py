@@ -0,0 +1,29 @@
+"""Add unique (user_id, value) index to user_values
+
+Revision ID: 7edb2bcabc78
+Revises: 45ffb6f3afb4
+Create Date: 2026-10-18 12:00:00.000000
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7edb2bcabc78'
+down_revision = '45ffb6f3afb4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Оставляем по одной (самой свежей) записи на пару (user_id, value) перед созданием уникального индекса
+    op.execute("""
+        DELETE FROM user_values a
+        USING user_values b
+        WHERE a.user_id = b.user_id AND a.value = b.value AND a.id < b.id
+    """)
+    op.create_index('ux_user_values_user_id_value', 'user_values', ['user_id', 'value'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ux_user_values_user_id_value', table_name='user_values')
@@ -0,0 +1,24 @@
+"""Default user_values.created_date to CURRENT_DATE on the server
+
+Revision ID: b3f1c2d4e5a6
+Revises: 7edb2bcabc78
+Create Date: 2026-10-18 15:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c2d4e5a6'
+down_revision = '7edb2bcabc78'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column('user_values', 'created_date', server_default=sa.text('CURRENT_DATE'))
+
+
+def downgrade():
+    op.alter_column('user_values', 'created_date', server_default=None)
@@ -0,0 +1,27 @@
+"""Add user_values.first_seen_date
+
+Revision ID: c4d2e3f5a6b7
+Revises: b3f1c2d4e5a6
+Create Date: 2026-10-18 18:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d2e3f5a6b7'
+down_revision = 'b3f1c2d4e5a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Для существующих строк известна только дата последнего упоминания — берем ее
+    op.add_column('user_values', sa.Column('first_seen_date', sa.Date(), nullable=True))
+    op.execute("UPDATE user_values SET first_seen_date = created_date")
+    op.alter_column('user_values', 'first_seen_date', nullable=False, server_default=sa.text('CURRENT_DATE'))
+
+
+def downgrade():
+    op.drop_column('user_values', 'first_seen_date')
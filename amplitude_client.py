@@ -1,62 +1,211 @@
-
-import threading
+import json
 import logging
+import os
+
+from asyncio import Event, create_task, get_running_loop, to_thread, wait_for
+from asyncio import TimeoutError as AsyncioTimeoutError
+from collections import deque
+from dataclasses import dataclass
+from random import uniform
+from time import time
+from typing import Optional
+from uuid import uuid4
 
-from amplitude.client import Amplitude, BaseEvent
-from concurrent.futures import ThreadPoolExecutor
-from functools import wraps
+import httpx
 
 from config import settings
+from http_clients import create_http_client
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
 
 
+@dataclass
+class PipelineStats:
+    enqueued: int = 0
+    sent: int = 0
+    dropped: int = 0
+    spilled: int = 0
+    failed_flushes: int = 0
+
+
+class AmplitudePipeline:
+    # Неблокирующая отправка событий: кольцевой буфер в памяти, пакетная отправка
+    # по размеру или по таймеру, при переполнении — сброс на диск или отбрасывание
+    def __init__(self, api_key: str, endpoint: str, buffer_size: int, batch_size: int,
+                 flush_interval: float, spill_path: str = ""):
+        self.api_key = api_key
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.stats = PipelineStats()
+        self._buffer = deque(maxlen=buffer_size)
+        self._http = None
+        self._flush_task = None
+        self._wakeup = None
+        self._closing = False
+        self._spill_tasks = set()
+
+    def start(self):
+        if self._flush_task is None:
+            self._wakeup = Event()
+            self._http = create_http_client()
+            self._flush_task = create_task(self._flush_loop())
+
+    async def stop(self, timeout: float = 10):
+        if self._flush_task is None:
+            return
+        # Перед остановкой отправляем все, что накопилось
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await wait_for(self._flush_task, timeout)
+        except AsyncioTimeoutError:
+            logger.warning(f"Amplitude flush timed out, {len(self._buffer)} events left in buffer")
+        if self._buffer:
+            if self.spill_path:
+                await self._spill(self._drain_buffer())
+            else:
+                logger.warning(f"Dropping {len(self._buffer)} unsent Amplitude events")
+                self.stats.dropped += len(self._drain_buffer())
+        for task in list(self._spill_tasks):
+            await task
+        await self._http.aclose()
+        self._flush_task = None
+        self._closing = False
+
+    def track(self, event_type: str, user_id, event_properties: Optional[dict] = None):
+        event = {
+            "event_type": event_type,
+            "user_id": str(user_id),
+            "event_properties": {"source": "notification", **(event_properties or {})},
+            "time": int(time() * 1000),
+            # insert_id позволяет Amplitude отбросить дубликаты при повторной отправке
+            "insert_id": str(uuid4()),
+        }
+        try:
+            get_running_loop()
+            self.start()
+        except RuntimeError:
+            pass
+        if len(self._buffer) == self._buffer.maxlen:
+            self._handle_overflow()
+        self._buffer.append(event)
+        self.stats.enqueued += 1
+        if self._flush_task is not None and len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _handle_overflow(self):
+        if self.spill_path and self._flush_task is not None:
+            events = self._drain_buffer()
+            task = create_task(self._spill(events))
+            self._spill_tasks.add(task)
+            task.add_done_callback(self._spill_tasks.discard)
+        else:
+            self._buffer.popleft()
+            self.stats.dropped += 1
+
+    def _drain_buffer(self) -> list:
+        events = list(self._buffer)
+        self._buffer.clear()
+        return events
+
+    async def _spill(self, events: list):
+        try:
+            await to_thread(self._append_spill_file, events)
+            self.stats.spilled += len(events)
+        except OSError as e:
+            self.stats.dropped += len(events)
+            logger.error(f"Failed to spill {len(events)} Amplitude events to disk: {e}")
+
+    def _append_spill_file(self, events: list):
+        with open(self.spill_path, "a", encoding="utf-8") as spill_file:
+            spill_file.writelines(json.dumps(event) + "\n" for event in events)
+
+    def _take_spill_file(self) -> list:
+        sending_path = self.spill_path + ".sending"
+        if not os.path.exists(sending_path):
+            if not os.path.exists(self.spill_path):
+                return []
+            os.replace(self.spill_path, sending_path)
+        with open(sending_path, encoding="utf-8") as spill_file:
+            events = [json.loads(line) for line in spill_file if line.strip()]
+        os.remove(sending_path)
+        return events
+
+    async def _flush_loop(self):
+        backoff = self.flush_interval
+        while True:
+            try:
+                await wait_for(self._wakeup.wait(), backoff)
+            except AsyncioTimeoutError:
+                pass
+            self._wakeup.clear()
+            ok = await self._flush()
+            if ok and self.spill_path and not self._buffer:
+                ok = await self._resend_spilled()
+            if self._closing:
+                return
+            # При недоступности Amplitude увеличиваем паузу между попытками (с jitter)
+            backoff = self.flush_interval if ok else min(backoff * 2, 60) * uniform(0.8, 1.2)
+
+    async def _flush(self) -> bool:
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            if not await self._send(batch):
+                # Возвращаем пакет в начало буфера; если места нет, старые события отбрасываются
+                free = self._buffer.maxlen - len(self._buffer)
+                self.stats.dropped += max(0, len(batch) - free)
+                self._buffer.extendleft(reversed(batch[:free] if free < len(batch) else batch))
+                return False
+        return True
+
+    async def _resend_spilled(self) -> bool:
+        try:
+            events = await to_thread(self._take_spill_file)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read spilled Amplitude events: {e}")
+            return True
+        for start in range(0, len(events), self.batch_size):
+            batch = events[start:start + self.batch_size]
+            if not await self._send(batch):
+                await self._spill(events[start:])
+                return False
+        return True
+
+    async def _send(self, batch: list) -> bool:
+        try:
+            response = await self._http.post(self.endpoint, json={"api_key": self.api_key, "events": batch})
+        except httpx.HTTPError as e:
+            self.stats.failed_flushes += 1
+            logger.error(f"Failed to send {len(batch)} events to Amplitude: {e}")
+            return False
+        if response.status_code == 200:
+            self.stats.sent += len(batch)
+            logger.info(f"{len(batch)} events successfully sent to Amplitude")
+            return True
+        if response.status_code == 400:
+            # Некорректный пакет повторять бессмысленно
+            self.stats.dropped += len(batch)
+            logger.error(f"Amplitude rejected {len(batch)} events: {response.text}")
+            return True
+        self.stats.failed_flushes += 1
+        logger.error(f"Amplitude responded {response.status_code} for {len(batch)} events")
+        return False
+
+
+amplitude_pipeline = AmplitudePipeline(
+    api_key=settings.AMPLITUDE_API_KEY,
+    endpoint=settings.AMPLITUDE_ENDPOINT,
+    buffer_size=settings.AMPLITUDE_BUFFER_SIZE,
+    batch_size=settings.AMPLITUDE_BATCH_SIZE,
+    flush_interval=settings.AMPLITUDE_FLUSH_INTERVAL,
+    spill_path=settings.AMPLITUDE_SPILL_PATH,
+)
+
+register_collector("bot_amplitude", lambda: amplitude_pipeline.stats, "Amplitude event pipeline")
 
-# Инициализация логирования
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
 
-amplitude = Amplitude(settings.AMPLITUDE_API_KEY)
-
-# Singleton для ThreadPoolExecutor
-class SingletonThreadPoolExecutor:
-    _instance = None
-    _lock = threading.Lock()
-
-    def __new__(cls, *args, **kwargs):
-        with cls._lock:
-            if not cls._instance:
-                cls._instance = super().__new__(cls, *args, **kwargs)
-                cls._instance.executor = ThreadPoolExecutor(max_workers=5)
-        return cls._instance
-
-# Функция для отправки ивентов в Amplitude
-def send_event_to_amplitude(event_type, user_id, event_properties=None):
-    if event_properties is None:
-        event_properties = {}
-    
-    event = BaseEvent(
-            event_type=event_type,
-            user_id=str(user_id),
-            event_properties={
-                "source": "notification"
-            }
-        )
-    try:
-        amplitude.track(event)
-        logging.info(f"Event '{event_type}' successfully sent for user '{user_id}'")
-    except Exception as e:
-        logging.error(f"Failed to send event '{event_type}' for user '{user_id}': {str(e)}")
-
-
-
-# Декоратор для выполнения функции в отдельном потоке
-def run_in_thread_pool(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        executor = SingletonThreadPoolExecutor().executor
-        future = executor.submit(func, *args, **kwargs)
-        return future
-    return wrapper
-
-@run_in_thread_pool
 def track_user_event(event_name, user_id, event_properties=None):
-    send_event_to_amplitude(event_name, user_id, event_properties)
+    amplitude_pipeline.track(event_name, user_id, event_properties)
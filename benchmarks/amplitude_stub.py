@@ -0,0 +1,58 @@
+"""Local stand-in for the Amplitude batch endpoint.
+
+Point the bot at it with AMPLITUDE_ENDPOINT=http://localhost:8090/batch.
+--fail-rate and --latency simulate an unhealthy upstream; received event
+counts are printed every few seconds.
+
+    python benchmarks/amplitude_stub.py --port 8090 --fail-rate 0.2 --latency 0.05
+"""
+import argparse
+import asyncio
+import random
+
+from aiohttp import web
+
+
+def make_app(fail_rate: float, latency: float) -> web.Application:
+    counters = {"batches": 0, "events": 0, "failed": 0, "insert_ids": set()}
+
+    async def batch(request):
+        await asyncio.sleep(latency)
+        if random.random() < fail_rate:
+            counters["failed"] += 1
+            return web.json_response({"code": 503, "error": "stub failure"}, status=503)
+        payload = await request.json()
+        events = payload.get("events", [])
+        counters["batches"] += 1
+        counters["events"] += len(events)
+        counters["insert_ids"].update(event.get("insert_id") for event in events)
+        return web.json_response({"code": 200, "events_ingested": len(events)})
+
+    async def report(app):
+        while True:
+            await asyncio.sleep(5)
+            print(
+                f"batches={counters['batches']} events={counters['events']} "
+                f"unique={len(counters['insert_ids'])} failed={counters['failed']}"
+            )
+
+    async def start_report(app):
+        app["report"] = asyncio.create_task(report(app))
+
+    async def stop_report(app):
+        app["report"].cancel()
+
+    app = web.Application()
+    app.router.add_post("/batch", batch)
+    app.on_startup.append(start_report)
+    app.on_cleanup.append(stop_report)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(make_app(args.fail_rate, args.latency), port=args.port)
@@ -0,0 +1,104 @@
+"""Per-message latency and disk IOPS: temp files on disk vs in-memory buffers.
+
+Simulates the I/O done by one voice message before and after the in-memory
+pipeline: download the user's voice note, hand it to the transcriber, write
+the TTS reply and hand it to the uploader.
+
+    python benchmarks/bench_audio_io.py --messages 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from io import BytesIO
+from uuid import uuid4
+
+VOICE_SIZE = 40 * 1024
+REPLY_SIZE = 80 * 1024
+
+
+class IOCounter:
+    def __init__(self):
+        self.ops = 0
+
+
+async def file_path_message(workdir, voice, reply, counter):
+    # download_file(file_path, unique_filename)
+    voice_path = os.path.join(workdir, str(uuid4()) + "_voice.ogg")
+    with open(voice_path, "wb") as f:
+        f.write(voice)
+    counter.ops += 1
+    # transcribe_audio_file(unique_filename) reads it back
+    with open(voice_path, "rb") as f:
+        f.read()
+    counter.ops += 1
+    # send_bot_voice_response writes the reply, FSInputFile reads it
+    reply_path = os.path.join(workdir, str(uuid4()) + "_response.ogg")
+    with open(reply_path, "wb") as f:
+        f.write(reply)
+    counter.ops += 1
+    with open(reply_path, "rb") as f:
+        f.read()
+    counter.ops += 1
+    os.remove(reply_path)
+    os.remove(voice_path)
+    counter.ops += 2
+    await asyncio.sleep(0)
+
+
+async def in_memory_message(workdir, voice, reply, counter):
+    buffer = BytesIO()
+    buffer.write(voice)
+    buffer.getvalue()
+    # BufferedInputFile just wraps the bytes
+    BytesIO(reply).read()
+    await asyncio.sleep(0)
+
+
+async def run(mode, messages, concurrency):
+    voice = os.urandom(VOICE_SIZE)
+    reply = os.urandom(REPLY_SIZE)
+    counter = IOCounter()
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                await mode(workdir, voice, reply, counter)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(messages)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "msg_per_s": messages / elapsed,
+        "disk_ops": counter.ops,
+        "iops": counter.ops / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    for name, mode in (("file path", file_path_message), ("in memory", in_memory_message)):
+        result = asyncio.run(run(mode, args.messages, args.concurrency))
+        print(
+            f"{name:10s} p50={result['p50_ms']:.3f}ms p95={result['p95_ms']:.3f}ms "
+            f"msg/s={result['msg_per_s']:.0f} disk_ops={result['disk_ops']} iops={result['iops']:.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
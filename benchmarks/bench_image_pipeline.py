@@ -0,0 +1,102 @@
+"""Bytes sent to the vision model and mood latency: full-size photo vs downscaled.
+
+Without --live only the payload side is measured (base64 size and encode
+time) on a synthetic photo. With --live both payloads are also sent to
+gpt-4o the way get_mood does and the request latency is reported.
+
+    python benchmarks/bench_image_pipeline.py --size 2560x1920 --repeat 5 [--live]
+"""
+import argparse
+import asyncio
+import base64
+import os
+import statistics
+import sys
+import time
+
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from some_utils import prepare_image  # noqa: E402
+
+PROMPT = "determine the mood from the photo, return only the type of mood in a few words without explanatory comments"
+
+
+def make_photo(width: int, height: int) -> bytes:
+    # Гладкий градиент с шумом сжимается примерно как настоящая фотография
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    noise = np.random.default_rng(0).normal(0, 12, (height, width, 3))
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1) + noise
+    with BytesIO() as jpeg_file:
+        Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(jpeg_file, format='JPEG', quality=92)
+        return jpeg_file.getvalue()
+
+
+def original_payload(image_data):
+    return base64.b64encode(image_data).decode('utf-8'), 'image/jpeg', 'auto'
+
+
+def downscaled_payload(image_data, max_side, quality, detail):
+    base64_image, mime_type = prepare_image(image_data, max_side, quality)
+    return base64_image, mime_type, detail
+
+
+async def mood_latency(client, payload):
+    base64_image, mime_type, detail = payload
+    started = time.perf_counter()
+    await client.chat.completions.create(
+        model="gpt-4o",
+        messages=[{"role": "user", "content": [
+            {"type": "text", "text": PROMPT},
+            {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}", "detail": detail}},
+        ]}],
+        max_tokens=300,
+    )
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="2560x1920")
+    parser.add_argument("--max-side", type=int, default=512)
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--detail", default="low")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--live", action="store_true", help="also call gpt-4o (needs OPENAI_API_KEY)")
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split("x"))
+    image_data = make_photo(width, height)
+    variants = {
+        "original": lambda: original_payload(image_data),
+        "downscaled": lambda: downscaled_payload(image_data, args.max_side, args.quality, args.detail),
+    }
+
+    client = None
+    if args.live:
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI()
+
+    for name, build in variants.items():
+        encode_times = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            payload = build()
+            encode_times.append(time.perf_counter() - started)
+        line = (
+            f"{name:10s} bytes sent={len(payload[0])} "
+            f"encode median={statistics.median(encode_times) * 1000:.1f}ms"
+        )
+        if client is not None:
+            latencies = [asyncio.run(mood_latency(client, payload)) for _ in range(args.repeat)]
+            line += f" mood latency median={statistics.median(latencies):.2f}s"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
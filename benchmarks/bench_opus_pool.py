@@ -0,0 +1,84 @@
+"""Event-loop lag while transcoding N concurrent TTS replies to OGG/Opus.
+
+"inline" runs the transcode on the event loop, like the old
+convert_to_ogg_opus did; "pool" goes through the bounded process pool.
+
+    python benchmarks/bench_opus_pool.py --replies 16 --seconds 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from io import BytesIO
+
+import numpy as np
+from soundfile import write
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from some_utils import convert_to_ogg_opus, shutdown_transcode_pool, transcode_stats, transcode_to_ogg_opus  # noqa: E402
+
+SAMPLE_RATE = 24000
+
+
+def make_reply(seconds: float) -> bytes:
+    t = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    signal = 0.2 * np.sin(2 * np.pi * 220 * t).astype('float32')
+    with BytesIO() as wav:
+        write(wav, signal, SAMPLE_RATE, format='WAV')
+        return wav.getvalue()
+
+
+async def measure_lag(stop: asyncio.Event, lags: list, interval=0.01):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def inline(audio):
+    transcode_to_ogg_opus(audio)
+
+
+async def pooled(audio):
+    await convert_to_ogg_opus(audio)
+
+
+async def run(mode, replies, audio):
+    lags = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(measure_lag(stop, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(mode(audio) for _ in range(replies)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    lags.sort()
+    return elapsed, lags[len(lags) // 2], lags[int(len(lags) * 0.99) - 1], lags[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replies", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=20.0, help="length of each reply")
+    args = parser.parse_args()
+
+    audio = make_reply(args.seconds)
+    for name, mode in (("inline", inline), ("pool", pooled)):
+        elapsed, p50, p99, worst = asyncio.run(run(mode, args.replies, audio))
+        print(
+            f"{name:6s} total={elapsed:.2f}s loop lag p50={p50 * 1000:.1f}ms "
+            f"p99={p99 * 1000:.1f}ms max={worst * 1000:.1f}ms"
+        )
+    print(
+        f"pool: completed={transcode_stats.completed} failed={transcode_stats.failed} "
+        f"avg encode={transcode_stats.encode_time_total / max(transcode_stats.completed, 1) * 1000:.1f}ms "
+        f"max encode={transcode_stats.encode_time_max * 1000:.1f}ms"
+    )
+    shutdown_transcode_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Redis commands per message for looking up a chat's assistant thread.
+
+Compares the old path (thread_id read from the FSM data dict via
+RedisStorage on every message) with thread_registry: a Redis hash with an
+in-process LRU and HSETNX on creation. Counts commands from INFO
+commandstats on a local Redis, so run it against a scratch instance.
+
+    python benchmarks/bench_thread_registry.py redis://localhost:6379/15 --chats 1000 --messages 20
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from redis.asyncio import Redis
+
+from thread_registry import ThreadRegistry
+
+thread_ids = itertools.count(1)
+
+
+async def create_thread() -> str:
+    return f"thread_{next(thread_ids)}"
+
+
+async def total_commands(redis) -> int:
+    stats = await redis.info("commandstats")
+    # Сам INFO тоже попадает в статистику
+    return sum(value["calls"] for name, value in stats.items() if name != "cmdstat_info")
+
+
+def fsm_context(storage, chat_id) -> FSMContext:
+    return FSMContext(storage, StorageKey(bot_id=1, chat_id=chat_id, user_id=chat_id))
+
+
+async def legacy_lookup(storage, chat_id):
+    state = fsm_context(storage, chat_id)
+    data = await state.get_data()
+    thread_id = data.get(str(chat_id))
+    if not thread_id:
+        thread_id = await create_thread()
+        await state.update_data({str(chat_id): thread_id})
+    return thread_id
+
+
+async def measure(redis, name, lookup, chats, messages):
+    await redis.flushdb()
+    await redis.config_resetstat()
+    started = time.perf_counter()
+    for _ in range(messages):
+        await asyncio.gather(*[lookup(chat_id) for chat_id in range(1, chats + 1)])
+    elapsed = time.perf_counter() - started
+    commands = await total_commands(redis)
+    total = chats * messages
+    print(f"{name:22} {commands / total:6.2f} redis commands/msg, {elapsed / total * 1e6:8.1f} us/msg")
+
+
+async def main(url, chats, messages, max_turns):
+    redis = Redis.from_url(url)
+    storage = RedisStorage(redis)
+    await measure(redis, "fsm get_data", lambda chat_id: legacy_lookup(storage, chat_id), chats, messages)
+
+    registry = ThreadRegistry(max_entries=chats, ttl=0, max_turns=0, local_ttl=60)
+    registry.setup(redis)
+    await measure(redis, "registry", lambda chat_id: registry.get_or_create(chat_id, create_thread), chats, messages)
+
+    cold = ThreadRegistry(max_entries=chats // 10 or 1, ttl=0, max_turns=0, local_ttl=60)
+    cold.setup(redis)
+    await measure(redis, "registry, 10% LRU", lambda chat_id: cold.get_or_create(chat_id, create_thread), chats, messages)
+
+    rotating = ThreadRegistry(max_entries=chats, ttl=0, max_turns=max_turns, local_ttl=60)
+    rotating.setup(redis)
+    await measure(
+        redis, f"registry, rotate@{max_turns}",
+        lambda chat_id: rotating.get_or_create(chat_id, create_thread), chats, messages,
+    )
+    print(f"rotations: {rotating.stats.rotated}")
+    await redis.flushdb()
+    await redis.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--max-turns", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.url, args.chats, args.messages, args.max_turns))
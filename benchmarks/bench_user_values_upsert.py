@@ -0,0 +1,113 @@
+"""Write latency of user_values saves against a local Postgres with 1M+ rows.
+
+Compares the old path (per-value DELETE + INSERT, no index on user_id) with
+the bulk INSERT ... ON CONFLICT DO UPDATE backed by the unique
+(user_id, value) index. The upsert is the statement UnitOfWork executes
+(database.upsert_values_statement), built and compiled for the scratch
+table on every save and run through asyncpg. Works on scratch tables, the
+real user_values table is not touched.
+
+    python benchmarks/bench_user_values_upsert.py postgresql://postgres@localhost/bench --rows 1000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+from functools import lru_cache
+
+import asyncpg
+from sqlalchemy import MetaData
+from sqlalchemy.dialects.postgresql.asyncpg import dialect as asyncpg_dialect
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from database import upsert_values_statement
+from models import UserValue
+
+VALUES = ["family", "health", "freedom", "honesty", "career", "friendship", "love", "growth"]
+
+
+async def seed(conn, table, rows, unique_index):
+    await conn.execute(f"DROP TABLE IF EXISTS {table}")
+    await conn.execute(f"""
+        CREATE TABLE {table} (
+            id serial PRIMARY KEY,
+            user_id integer NOT NULL,
+            value varchar(255) NOT NULL,
+            created_date date NOT NULL DEFAULT current_date,
+            first_seen_date date NOT NULL DEFAULT current_date
+        )
+    """)
+    await conn.execute(
+        f"INSERT INTO {table} (user_id, value) SELECT g / 8, 'seed-' || (g % 8) FROM generate_series(1, $1) AS g",
+        rows,
+    )
+    if unique_index:
+        await conn.execute(f"CREATE UNIQUE INDEX ON {table} (user_id, value)")
+    await conn.execute(f"ANALYZE {table}")
+
+
+async def old_path(conn, table, user_id, values):
+    # save_user_value: одна сессия и транзакция на каждое значение
+    for value in values:
+        async with conn.transaction():
+            await conn.execute(f"DELETE FROM {table} WHERE user_id = $1 AND value = $2", user_id, value)
+            await conn.execute(f"INSERT INTO {table} (user_id, value) VALUES ($1, $2)", user_id, value)
+
+
+@lru_cache()
+def scratch_table(name):
+    return UserValue.__table__.to_metadata(MetaData(), name=name)
+
+
+async def upsert_path(conn, table, user_id, values):
+    # Тот же оператор, что в UnitOfWork.commit, только над копией таблицы
+    statement = upsert_values_statement(
+        [{"user_id": user_id, "value": value} for value in values],
+        scratch_table(table),
+    )
+    compiled = statement.compile(dialect=asyncpg_dialect(paramstyle="numeric_dollar"))
+    async with conn.transaction():
+        await conn.execute(str(compiled), *(compiled.params[name] for name in compiled.positiontup))
+
+
+async def measure(conn, table, path, turns, max_user_id):
+    latencies = []
+    for _ in range(turns):
+        user_id = random.randint(1, max_user_id)
+        values = random.sample(VALUES, 3)
+        started = time.perf_counter()
+        await path(conn, table, user_id, values)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+async def main(dsn, rows, turns):
+    conn = await asyncpg.connect(dsn)
+    try:
+        for name, table, path, unique_index in (
+            ("delete+insert, no index", "bench_user_values_old", old_path, False),
+            ("bulk upsert, unique idx", "bench_user_values_new", upsert_path, True),
+        ):
+            started = time.perf_counter()
+            await seed(conn, table, rows, unique_index)
+            seeded = time.perf_counter() - started
+            p50, p95 = await measure(conn, table, path, turns, rows // 8)
+            print(f"{name}: seeded {rows} rows in {seeded:.1f}s, save 3 values p50={p50 * 1000:.2f}ms p95={p95 * 1000:.2f}ms")
+            await conn.execute(f"DROP TABLE {table}")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dsn", help="plain postgresql:// DSN of a scratch database")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.dsn, args.rows, args.turns))
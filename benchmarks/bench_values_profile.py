@@ -0,0 +1,131 @@
+"""Read-side latency of user_values queries against a local Postgres with millions of rows.
+
+Seeds a scratch table shaped like user_values (unique (user_id, value)
+index, first_seen_date / created_date) and measures the queries behind
+values_profile:
+
+* profile — one user's values with first/last seen, as for /values and the
+  assistant context (index range scan on user_id);
+* top     — most common values across users (full aggregate, which is why
+  values_cache keeps it for VALUES_TOP_TTL);
+* export  — streaming every row through a server-side cursor versus one
+  fetch() of the whole table, with wall time and peak RSS growth.
+
+The real user_values table is not touched.
+
+    python benchmarks/bench_values_profile.py postgresql://postgres@localhost/bench --rows 5000000
+"""
+import argparse
+import asyncio
+import random
+import resource
+import statistics
+import time
+
+import asyncpg
+
+TABLE = "bench_user_values_profile"
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def seed(conn, rows):
+    await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    await conn.execute(f"""
+        CREATE TABLE {TABLE} (
+            id serial PRIMARY KEY,
+            user_id integer NOT NULL,
+            value varchar(255) NOT NULL,
+            created_date date NOT NULL DEFAULT current_date,
+            first_seen_date date NOT NULL DEFAULT current_date
+        )
+    """)
+    # 8 ценностей на пользователя из 36 возможных: value-0 есть у всех, остальные встречаются реже
+    await conn.execute(
+        f"""
+        INSERT INTO {TABLE} (user_id, value, first_seen_date, created_date)
+        SELECT g / 8, 'value-' || (g % 8 + 8 * ((g / 8) % (g % 8 + 1))),
+               current_date - (g % 365), current_date - (g % 30)
+        FROM generate_series(1, $1) AS g
+        """,
+        rows,
+    )
+    await conn.execute(f"CREATE UNIQUE INDEX ON {TABLE} (user_id, value)")
+    await conn.execute(f"ANALYZE {TABLE}")
+
+
+async def measure(conn, query, args_factory, runs):
+    latencies = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        await conn.fetch(query, *args_factory())
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return statistics.median(latencies), latencies[max(0, int(len(latencies) * 0.95) - 1)]
+
+
+async def export_cursor(conn, batch):
+    exported = 0
+    async with conn.transaction():
+        async for _ in conn.cursor(
+            f"SELECT user_id, value, first_seen_date, created_date FROM {TABLE} ORDER BY user_id, value",
+            prefetch=batch,
+        ):
+            exported += 1
+    return exported
+
+
+async def export_fetch_all(conn):
+    rows = await conn.fetch(f"SELECT user_id, value, first_seen_date, created_date FROM {TABLE} ORDER BY user_id, value")
+    return len(rows)
+
+
+async def main(args):
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        started = time.perf_counter()
+        await seed(conn, args.rows)
+        print(f"seeded {args.rows} rows in {time.perf_counter() - started:.1f}s")
+        max_user_id = args.rows // 8
+
+        p50, p95 = await measure(
+            conn,
+            f"SELECT value, first_seen_date, created_date FROM {TABLE} WHERE user_id = $1 "
+            f"ORDER BY created_date DESC, id DESC",
+            lambda: (random.randint(1, max_user_id),),
+            args.runs,
+        )
+        print(f"profile: p50={p50 * 1000:.2f}ms p95={p95 * 1000:.2f}ms")
+
+        p50, p95 = await measure(
+            conn,
+            f"SELECT value, count(*) AS users, min(first_seen_date), max(created_date) FROM {TABLE} "
+            f"GROUP BY value ORDER BY users DESC, value LIMIT $1",
+            lambda: (args.top,),
+            max(3, args.runs // 20),
+        )
+        print(f"top {args.top}: p50={p50 * 1000:.0f}ms p95={p95 * 1000:.0f}ms")
+
+        # Курсор первым: ru_maxrss только растет, так что fetch() после него покажет свой пик
+        for name, export in (("cursor", lambda: export_cursor(conn, args.batch)), ("fetch()", lambda: export_fetch_all(conn))):
+            rss_before = peak_rss_mb()
+            started = time.perf_counter()
+            exported = await export()
+            elapsed = time.perf_counter() - started
+            print(f"export {name:7}: {exported} rows in {elapsed:.1f}s ({exported / elapsed:,.0f} rows/s), "
+                  f"peak RSS +{peak_rss_mb() - rss_before:.0f} MB")
+        await conn.execute(f"DROP TABLE {TABLE}")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dsn", help="plain postgresql:// DSN of a scratch database")
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--runs", type=int, default=500)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=5000, help="server-side cursor prefetch")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,518 @@
+"""Local stand-ins for the OpenAI and Telegram Bot APIs used by the bot.
+
+FakeOpenAI covers what openai_client.py calls: chat completions (plain,
+vision and tool calls), assistants threads/runs with SSE streaming and
+tool outputs, thread messages, files, audio speech (full body and
+streamed PCM) and transcriptions. It also accepts Amplitude batches at
+/amplitude/batch. Every endpoint sleeps for a configurable latency.
+
+FakeTelegram serves getUpdates from a queue fed by the benchmark, file
+downloads for voice/photo updates, and records sendVoice/sendMessage
+replies per chat so the benchmark can measure end-to-end latency.
+
+Both can also be run standalone:
+
+    python benchmarks/fake_servers.py --openai-port 8181 --telegram-port 8182 --latency run=1.0 --latency tts=0.4
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import random
+import time
+import wave
+
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+DEFAULT_LATENCY = {
+    "chat": 0.6,
+    "vision": 1.2,
+    "thread": 0.15,
+    "run": 1.5,
+    # Дополнительная задержка run-а на каждую 1000 токенов промпта
+    "run_per_1k_tokens": 0.1,
+    "tool_outputs": 0.8,
+    "messages": 0.15,
+    "files": 0.1,
+    "tts": 0.5,
+    "transcription": 0.7,
+    "telegram": 0.03,
+}
+REPLY_TEXT = (
+    "Hello! I am glad to hear from you. It sounds like family and health matter a lot to you. "
+    "Would you like to talk about what helps you feel calm during a busy day?"
+)
+PCM_SAMPLE_RATE = 24000
+# Примерная скорость речи TTS: символов в секунду
+SPEECH_CHARS_PER_SECOND = 15
+
+
+def silence_pcm(seconds: float) -> bytes:
+    return b"\x00\x00" * int(PCM_SAMPLE_RATE * seconds)
+
+
+def silence_wav(seconds: float) -> bytes:
+    with io.BytesIO() as buffer:
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(PCM_SAMPLE_RATE)
+            wav.writeframes(silence_pcm(seconds))
+        return buffer.getvalue()
+
+
+def sse(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class FakeOpenAI:
+    def __init__(self, latency: dict, tool_call_rate: float = 0.5, reply_text: str = REPLY_TEXT):
+        self.latency = {**DEFAULT_LATENCY, **latency}
+        self.tool_call_rate = tool_call_rate
+        self.reply_text = reply_text
+        self.ids = itertools.count(1)
+        self.threads = defaultdict(list)
+        self.run_options = {}
+        self.last_prompt_tokens = {}
+        self.requests = defaultdict(int)
+        self.amplitude_events = 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/threads", self.create_thread)
+        app.router.add_delete("/v1/threads/{thread_id}", self.delete_thread)
+        app.router.add_post("/v1/threads/{thread_id}/runs", self.create_run)
+        app.router.add_post("/v1/threads/{thread_id}/runs/{run_id}/submit_tool_outputs", self.submit_tool_outputs)
+        app.router.add_get("/v1/threads/{thread_id}/messages", self.list_messages)
+        app.router.add_post("/v1/threads/{thread_id}/messages", self.create_message)
+        app.router.add_get("/v1/files/{file_id}", self.retrieve_file)
+        app.router.add_get("/v1/models", self.list_models)
+        app.router.add_post("/v1/audio/speech", self.speech)
+        app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        app.router.add_post("/amplitude/batch", self.amplitude_batch)
+        return app
+
+    async def _delay(self, endpoint: str):
+        self.requests[endpoint] += 1
+        await asyncio.sleep(self.latency[endpoint])
+
+    def _id(self, prefix: str) -> str:
+        return f"{prefix}_{next(self.ids)}"
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        tools = body.get("tools") or []
+        content = body["messages"][-1]["content"]
+        is_vision = isinstance(content, list)
+        await self._delay("vision" if is_vision else "chat")
+        message = {"role": "assistant", "content": None}
+        if tools:
+            name = tools[0]["function"]["name"]
+            if name == "classify_life_values":
+                values = json.loads(content.rsplit("\n", 1)[-1])
+                arguments = {"verdicts": [{"value": value, "true_false": "true"} for value in values]}
+            else:
+                arguments = {"true_false": "true"}
+            message["tool_calls"] = [{
+                "id": self._id("call"),
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(arguments)},
+            }]
+        elif is_vision:
+            message["content"] = "calm and happy"
+        else:
+            message["content"] = "The user talked about family, health and work."
+        return web.json_response({
+            "id": self._id("chatcmpl"),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+            "usage": {"prompt_tokens": 50, "completion_tokens": 10, "total_tokens": 60},
+        })
+
+    async def create_thread(self, request):
+        body = await request.json() if request.can_read_body else {}
+        await self._delay("thread")
+        thread_id = self._id("thread")
+        self.threads[thread_id] = [
+            self._message(thread_id, message.get("role", "user"), message["content"])
+            for message in body.get("messages") or []
+        ]
+        return web.json_response({"id": thread_id, "object": "thread", "created_at": int(time.time()), "metadata": {}})
+
+    async def delete_thread(self, request):
+        await self._delay("thread")
+        thread_id = request.match_info["thread_id"]
+        self.threads.pop(thread_id, None)
+        return web.json_response({"id": thread_id, "object": "thread.deleted", "deleted": True})
+
+    def _message(self, thread_id, role, text, run_id=None):
+        return {
+            "id": self._id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+            "status": "completed",
+            "run_id": run_id,
+            "assistant_id": None,
+            "attachments": [],
+            "metadata": {},
+        }
+
+    def _prompt_tokens(self, thread_id, run_id) -> int:
+        # Грубая оценка: ~4 символа на токен, с учетом truncation_strategy и max_prompt_tokens
+        options = self.run_options.get(run_id, {})
+        messages = self.threads[thread_id]
+        truncation = options.get("truncation_strategy") or {}
+        if truncation.get("type") == "last_messages":
+            messages = messages[-truncation["last_messages"]:]
+        characters = sum(len(message["content"][0]["text"]["value"]) for message in messages)
+        characters += len(options.get("additional_instructions") or "")
+        prompt_tokens = 200 + characters // 4
+        if options.get("max_prompt_tokens"):
+            prompt_tokens = min(prompt_tokens, options["max_prompt_tokens"])
+        return prompt_tokens
+
+    def _run_delay(self, thread_id, run_id) -> float:
+        return self.latency["run"] + self._prompt_tokens(thread_id, run_id) / 1000 * self.latency["run_per_1k_tokens"]
+
+    def _run(self, thread_id, run_id, assistant_id, status, required_action=None):
+        prompt_tokens = self._prompt_tokens(thread_id, run_id)
+        if status == "completed":
+            self.last_prompt_tokens[thread_id] = prompt_tokens
+        return {
+            "id": run_id,
+            "object": "thread.run",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "assistant_id": assistant_id,
+            "status": status,
+            "required_action": required_action,
+            "tools": [],
+            "metadata": {},
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 40, "total_tokens": prompt_tokens + 40},
+        }
+
+    async def _stream(self, request, events):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for delay, event, data in events:
+            if delay:
+                await asyncio.sleep(delay)
+            await response.write(sse(event, data))
+        await response.write(b"event: done\ndata: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _completion_events(self, thread_id, run_id, assistant_id):
+        run = self._run(thread_id, run_id, assistant_id, "completed")
+        self.run_options.pop(run_id, None)
+        message = self._message(thread_id, "assistant", self.reply_text, run_id)
+        self.threads[thread_id].append(message)
+        return [
+            (0, "thread.message.created", {**message, "status": "in_progress"}),
+            (0, "thread.message.completed", message),
+            (0, "thread.run.completed", run),
+        ]
+
+    async def create_run(self, request):
+        body = await request.json()
+        thread_id = request.match_info["thread_id"]
+        assistant_id = body.get("assistant_id")
+        for message in body.get("additional_messages") or []:
+            self.threads[thread_id].append(self._message(thread_id, "user", message["content"]))
+        self.requests["run"] += 1
+        run_id = self._id("run")
+        self.run_options[run_id] = {
+            key: body[key] for key in ("truncation_strategy", "max_prompt_tokens", "additional_instructions") if key in body
+        }
+        events = [(0, "thread.run.created", self._run(thread_id, run_id, assistant_id, "queued"))]
+        if random.random() < self.tool_call_rate:
+            required_action = {
+                "type": "submit_tool_outputs",
+                "submit_tool_outputs": {"tool_calls": [{
+                    "id": self._id("call"),
+                    "type": "function",
+                    "function": {"name": "save_value", "arguments": json.dumps({"values": ["family", "health"]})},
+                }]},
+            }
+            events.append((
+                self._run_delay(thread_id, run_id), "thread.run.requires_action",
+                self._run(thread_id, run_id, assistant_id, "requires_action", required_action),
+            ))
+        else:
+            delay = self._run_delay(thread_id, run_id)
+            completion = self._completion_events(thread_id, run_id, assistant_id)
+            events.append((delay,) + completion[0][1:])
+            events.extend(completion[1:])
+        return await self._stream(request, events)
+
+    async def submit_tool_outputs(self, request):
+        await request.json()
+        thread_id = request.match_info["thread_id"]
+        run_id = request.match_info["run_id"]
+        self.requests["tool_outputs"] += 1
+        completion = self._completion_events(thread_id, run_id, None)
+        events = [(self.latency["tool_outputs"],) + completion[0][1:]] + completion[1:]
+        return await self._stream(request, events)
+
+    async def list_messages(self, request):
+        await self._delay("messages")
+        messages = self.threads[request.match_info["thread_id"]]
+        if request.query.get("order", "desc") == "desc":
+            messages = list(reversed(messages))
+        messages = messages[:int(request.query.get("limit", 20))]
+        return web.json_response({"object": "list", "data": messages, "has_more": False})
+
+    async def create_message(self, request):
+        body = await request.json()
+        await self._delay("messages")
+        thread_id = request.match_info["thread_id"]
+        message = self._message(thread_id, body.get("role", "user"), body.get("content", ""))
+        self.threads[thread_id].append(message)
+        return web.json_response(message)
+
+    async def retrieve_file(self, request):
+        await self._delay("files")
+        return web.json_response({
+            "id": request.match_info["file_id"],
+            "object": "file",
+            "bytes": 9502,
+            "created_at": int(time.time()),
+            "filename": "anxiety.docx",
+            "purpose": "assistants",
+            "status": "processed",
+        })
+
+    async def list_models(self, request):
+        return web.json_response({"object": "list", "data": []})
+
+    async def speech(self, request):
+        body = await request.json()
+        self.requests["tts"] += 1
+        seconds = max(1.0, len(body.get("input", "")) / SPEECH_CHARS_PER_SECOND)
+        # Первый байт приходит после latency, остальное — по мере "генерации"
+        await asyncio.sleep(self.latency["tts"])
+        if body.get("response_format") == "pcm":
+            response = web.StreamResponse(headers={"Content-Type": "audio/pcm"})
+            await response.prepare(request)
+            pcm = silence_pcm(seconds)
+            chunk = PCM_SAMPLE_RATE * 2 // 4
+            for start in range(0, len(pcm), chunk):
+                await response.write(pcm[start:start + chunk])
+                await asyncio.sleep(0.02)
+            await response.write_eof()
+            return response
+        return web.Response(body=silence_wav(seconds), content_type="audio/wav")
+
+    async def transcriptions(self, request):
+        await request.post()
+        await self._delay("transcription")
+        return web.json_response({"text": "I value my family and my health. How can I sleep better?"})
+
+    async def amplitude_batch(self, request):
+        body = await request.json()
+        self.amplitude_events += len(body.get("events", []))
+        return web.json_response({"code": 200})
+
+
+class FakeTelegram:
+    # global_limit / chat_limit > 0 включают лимиты Telegram: сообщений за скользящую секунду
+    # на бота и на чат, сверх лимита — 429 с retry_after
+    def __init__(self, latency: float, voice_data: bytes, photo_data: bytes,
+                 global_limit: int = 0, chat_limit: int = 0):
+        self.latency = latency
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.sent_at = deque()
+        self.chat_sent_at = defaultdict(deque)
+        self.throttled = 0
+        self.voice_data = voice_data
+        self.photo_data = photo_data
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.waiters = {}
+        self.last_reply_at = {}
+        self.replies = 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.api)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.download)
+        return app
+
+    def _user(self, chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+
+    def push_update(self, chat_id: int, kind: str, unique_media: bool = False) -> asyncio.Future:
+        # Возвращает future, который завершится при первом ответе бота в этот чат
+        update_id = next(self.update_ids)
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"},
+            "from": self._user(chat_id),
+        }
+        suffix = f"_{update_id}" if unique_media else ""
+        if kind == "voice":
+            message["voice"] = {"file_id": f"voice{suffix}", "file_unique_id": f"uvoice{suffix}", "duration": 3}
+        elif kind == "photo":
+            message["photo"] = [
+                {"file_id": f"photo_s{suffix}", "file_unique_id": f"uphoto_s{suffix}", "width": 320, "height": 240},
+                {"file_id": f"photo_m{suffix}", "file_unique_id": f"uphoto_m{suffix}", "width": 800, "height": 600},
+                {"file_id": f"photo_l{suffix}", "file_unique_id": f"uphoto_l{suffix}", "width": 1280, "height": 960},
+            ]
+        else:
+            message["text"] = random.choice(["Hi!", "I love my family.", "How can I calm down?", "Thanks!"])
+        self.updates.append({"update_id": update_id, "message": message})
+        self.new_updates.set()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(chat_id, []).append(future)
+        return future
+
+    def _reply(self, chat_id: int):
+        self.replies += 1
+        self.last_reply_at[chat_id] = time.perf_counter()
+        waiters = self.waiters.get(chat_id)
+        while waiters:
+            future = waiters.pop(0)
+            if not future.done():
+                future.set_result(time.perf_counter())
+                break
+
+    async def api(self, request):
+        method = request.match_info["method"].lower()
+        form = await request.post()
+        if method == "getupdates":
+            offset = int(form.get("offset") or 0)
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if not self.updates:
+                self.new_updates.clear()
+                try:
+                    await asyncio.wait_for(self.new_updates.wait(), min(float(form.get("timeout") or 0), 1.0))
+                except asyncio.TimeoutError:
+                    pass
+            return web.json_response({"ok": True, "result": self.updates[:100]})
+
+        await asyncio.sleep(self.latency)
+        if method in ("sendvoice", "sendmessage") and self._over_limit(int(form["chat_id"])):
+            self.throttled += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getfile":
+            file_id = form.get("file_id", "")
+            path = f"voice/{file_id}.ogg" if file_id.startswith("voice") else f"photos/{file_id}.jpg"
+            result = {"file_id": file_id, "file_unique_id": "u" + file_id, "file_path": path}
+        elif method in ("sendvoice", "sendmessage"):
+            chat_id = int(form["chat_id"])
+            self._reply(chat_id)
+            result = {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+            }
+            if method == "sendvoice":
+                result["voice"] = {"file_id": f"sent_voice_{result['message_id']}",
+                                   "file_unique_id": f"usent_{result['message_id']}", "duration": 1}
+            else:
+                result["text"] = form.get("text", "")
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def _over_limit(self, chat_id: int) -> bool:
+        now = time.monotonic()
+        chat_sent_at = self.chat_sent_at[chat_id]
+        for sent_at in (self.sent_at, chat_sent_at):
+            while sent_at and sent_at[0] < now - 1:
+                sent_at.popleft()
+        if (self.global_limit and len(self.sent_at) >= self.global_limit) or \
+                (self.chat_limit and len(chat_sent_at) >= self.chat_limit):
+            return True
+        self.sent_at.append(now)
+        chat_sent_at.append(now)
+        return False
+
+    async def download(self, request):
+        await asyncio.sleep(self.latency)
+        path = request.match_info["path"]
+        data = self.voice_data if path.startswith("voice/") else self.photo_data
+        return web.Response(body=data)
+
+
+def sample_voice() -> bytes:
+    try:
+        import numpy as np
+        import soundfile
+        t = np.arange(48000 * 3) / 48000
+        signal = (0.2 * np.sin(2 * np.pi * 220 * t)).astype("float32")
+        with io.BytesIO() as buffer:
+            soundfile.write(buffer, signal, 48000, format="OGG", subtype="OPUS")
+            return buffer.getvalue()
+    except Exception:
+        return silence_wav(3)
+
+
+def sample_photo() -> bytes:
+    try:
+        from PIL import Image
+        with io.BytesIO() as buffer:
+            Image.new("RGB", (1280, 960), (120, 160, 200)).save(buffer, format="JPEG")
+            return buffer.getvalue()
+    except Exception:
+        return b"\xff\xd8\xff\xd9"
+
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def parse_latency(values) -> dict:
+    latency = {}
+    for value in values or []:
+        name, seconds = value.split("=")
+        latency[name] = float(seconds)
+    return latency
+
+
+async def serve(openai_port, telegram_port, latency, tool_call_rate):
+    fake_openai = FakeOpenAI(latency, tool_call_rate)
+    fake_telegram = FakeTelegram(fake_openai.latency["telegram"], sample_voice(), sample_photo())
+    runners = [
+        await start_site(fake_openai.make_app(), openai_port),
+        await start_site(fake_telegram.make_app(), telegram_port),
+    ]
+    print(f"OpenAI stub on :{openai_port}/v1, Telegram stub on :{telegram_port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--openai-port", type=int, default=8181)
+    parser.add_argument("--telegram-port", type=int, default=8182)
+    parser.add_argument("--latency", action="append", help="endpoint=seconds, e.g. run=1.5")
+    parser.add_argument("--tool-call-rate", type=float, default=0.5)
+    args = parser.parse_args()
+    asyncio.run(serve(args.openai_port, args.telegram_port, parse_latency(args.latency), args.tool_call_rate))
@@ -0,0 +1,84 @@
+"""Load test for the webhook entry point.
+
+Posts synthetic Telegram text updates to a running bot (BOT_MODE=webhook)
+and reports accepted updates/sec and latency percentiles of the webhook
+response. aiogram acknowledges an update before handling it (the handler
+runs in the background), so these numbers cover only the HTTP ack, not
+the assistant reply; run_bench.py measures end-to-end reply latency.
+
+    python benchmarks/webhook_load.py http://localhost:8080/webhook --secret $WEBHOOK_SECRET \
+        --updates 5000 --concurrency 100 --chats 500
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+from aiohttp import ClientSession, TCPConnector
+
+TEXTS = ["Hi!", "How are you?", "I value my family above all.", "Tell me about anxiety.", "Thanks"]
+
+
+def make_update(update_id: int, chat_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Load"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+            "text": random.choice(TEXTS),
+        },
+    }
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def main(url, secret, updates, concurrency, chats):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    update_ids = itertools.count(1)
+    latencies = []
+    errors = 0
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency), headers=headers) as session:
+        async def worker(count):
+            nonlocal errors
+            for _ in range(count):
+                update = make_update(next(update_ids), random.randint(1, chats))
+                started = time.perf_counter()
+                try:
+                    async with session.post(url, json=update) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        per_worker, extra = divmod(updates, concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(per_worker + (i < extra)) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"updates={updates} errors={errors} elapsed={elapsed:.2f}s acked updates/s={updates / elapsed:.0f}")
+    print(
+        f"ack latency p50={percentile(latencies, 0.50) * 1000:.1f}ms "
+        f"p95={percentile(latencies, 0.95) * 1000:.1f}ms "
+        f"p99={percentile(latencies, 0.99) * 1000:.1f}ms"
+    )
+    print("replies are produced in the background and not timed here; see run_bench.py for reply latency")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--chats", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.url, args.secret, args.updates, args.concurrency, args.chats))
@@ -1,106 +1,371 @@
 import logging
+import sys
 
-from os import remove
-from uuid import uuid4
-from asyncio import run as asyncio_run
-from aiogram import Bot, Dispatcher, types
+from argparse import ArgumentParser
+from time import perf_counter
+from asyncio import Event, gather, get_running_loop, run as asyncio_run
+from signal import SIGINT, SIGTERM
+from aiohttp import web
+from aiogram import Bot, Dispatcher, Router, types
 from aiogram.filters import Command
 from aiogram.types import ContentType
-from aiogram.types.input_file import FSInputFile
+from aiogram.types.input_file import BufferedInputFile
 from aiogram.fsm.storage.redis  import RedisStorage 
 from aiogram.fsm.context import FSMContext
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.exceptions import TelegramRetryAfter
 from redis.asyncio import Redis
 from urllib.parse import urlparse
 
-from openai_client import get_assistant_response, transcribe_audio_file, get_mood, get_tts_response
-from config import settings
-from amplitude_client import track_user_event
+from openai_client import (
+    get_client, close_client, transcribe_audio_file, get_mood, get_tts_response, stream_tts_response, tts_cache_key,
+    start_validation_workers, stop_validation_workers
+)
+from config import settings, REQUIRED_SETTINGS
+from database import ping_database, dispose_engine
+from amplitude_client import track_user_event, amplitude_pipeline
+from some_utils import shutdown_transcode_pool
+from tts_cache import tts_cache
+from mood_cache import mood_cache
+from file_cache import file_name_cache
+from thread_registry import thread_registry
+from values_profile import values_cache, format_profile
+from scheduler import turn_scheduler
+from send_queue import send_queue
+from http_clients import create_telegram_session, warm_up, get_connection_stats
+from metrics import timed, in_flight, count_error, start_metrics_server
 
-# Включаем логирование
-logging.basicConfig(level=logging.INFO)
+router = Router()
 
-API_TOKEN = settings.TELEGRAM_TOKEN
 
-parsed_url = urlparse(settings.REDIS_URL)
-r_client = Redis(host=parsed_url.hostname, port=parsed_url.port,password=parsed_url.password)
-storage = RedisStorage(r_client)
-bot = Bot(API_TOKEN)
-dp = Dispatcher(storage=storage)
+class Application:
+    # Клиенты создаются при первом обращении, а не при импорте модуля: импорт не требует
+    # ни учетных данных, ни сети. startup() прогревает соединения параллельно,
+    # shutdown() сначала дообрабатывает очереди, затем закрывает клиенты
+    def __init__(self):
+        self._redis = None
+        self._bot = None
+        self._dispatcher = None
+        self._metrics_runner = None
+
+    @property
+    def redis(self) -> Redis:
+        if self._redis is None:
+            settings.require("REDIS_URL")
+            parsed_url = urlparse(settings.REDIS_URL)
+            self._redis = Redis(host=parsed_url.hostname, port=parsed_url.port, password=parsed_url.password)
+            tts_cache.setup(self._redis)
+            values_cache.setup(self._redis)
+            mood_cache.setup(self._redis)
+            file_name_cache.setup(self._redis)
+            thread_registry.setup(self._redis)
+            if settings.BOT_MODE == "webhook":
+                # При polling процесс один, и очередь планировщика уже упорядочивает ходы чата
+                turn_scheduler.setup(self._redis)
+        return self._redis
+
+    @property
+    def bot(self) -> Bot:
+        if self._bot is None:
+            settings.require("TELEGRAM_TOKEN")
+            self._bot = Bot(settings.TELEGRAM_TOKEN, session=create_telegram_session())
+        return self._bot
+
+    @property
+    def dispatcher(self) -> Dispatcher:
+        if self._dispatcher is None:
+            self._dispatcher = Dispatcher(storage=RedisStorage(self.redis))
+            self._dispatcher.include_router(router)
+        return self._dispatcher
+
+    def checks(self) -> dict:
+        return {
+            "telegram": lambda: self.bot.get_me(),
+            "openai": lambda: get_client().models.list(),
+            "redis": lambda: self.redis.ping(),
+            "database": ping_database,
+        }
+
+    async def startup(self):
+        settings.require(*REQUIRED_SETTINGS)
+        start_validation_workers()
+        amplitude_pipeline.start()
+        started = perf_counter()
+        report = await warm_up(self.checks())
+        for name, (elapsed, error) in report.items():
+            if error is not None:
+                logging.warning(f"Connection warm-up failed for {name} after {elapsed:.2f}s: {error}")
+        logging.info(f"Warm-up finished in {perf_counter() - started:.2f}s")
+        if settings.METRICS_ENABLED:
+            self._metrics_runner = await start_metrics_server()
+
+    async def check(self) -> bool:
+        # Проверка конфигурации и доступности всех зависимостей без запуска бота
+        ok = True
+        try:
+            settings.require(*REQUIRED_SETTINGS)
+            print("settings: ok")
+        except RuntimeError as e:
+            print(f"settings: {e}")
+            ok = False
+        report = await warm_up(self.checks())
+        for name, (elapsed, error) in report.items():
+            print(f"{name}: {'ok' if error is None else f'FAILED ({error!r})'} in {elapsed * 1000:.0f}ms")
+            ok = ok and error is None
+        return ok
+
+    async def shutdown(self):
+        # Сначала параллельно дообрабатываем то, что еще отправляет запросы (каждая очередь
+        # ждет не дольше SHUTDOWN_TIMEOUT), затем закрываем клиенты, которыми они пользовались
+        await gather(
+            stop_validation_workers(settings.SHUTDOWN_TIMEOUT),
+            send_queue.stop(settings.SHUTDOWN_TIMEOUT),
+            amplitude_pipeline.stop(settings.SHUTDOWN_TIMEOUT),
+            return_exceptions=True,
+        )
+        shutdown_transcode_pool()
+        logging.info(f"Connection reuse: {get_connection_stats()}")
+        closers = [close_client(), dispose_engine()]
+        if self._bot is not None:
+            closers.append(self._bot.session.close())
+        if self._dispatcher is not None:
+            # RedisStorage закрывает и сам клиент Redis
+            closers.append(self._dispatcher.storage.close())
+        elif self._redis is not None:
+            closers.append(self._redis.aclose())
+        if self._metrics_runner is not None:
+            closers.append(self._metrics_runner.cleanup())
+        for result in await gather(*closers, return_exceptions=True):
+            if isinstance(result, Exception):
+                logging.warning(f"Error during shutdown: {result}")
+        self._redis = self._bot = self._dispatcher = self._metrics_runner = None
+
+
+application = Application()
 
 async def handle_exception(message, exception):
+    count_error("handler")
     logging.error(f"Exception occurred: {exception}")
-    await message.answer("Sorry, an error occurred. Please try again later.")
+    if isinstance(exception, TelegramRetryAfter):
+        # Чат и так упирается в лимит Telegram: еще одно сообщение только продлит паузу
+        return
+    try:
+        await send_queue.send(message.chat.id, lambda: message.answer("Sorry, an error occurred. Please try again later."))
+    except Exception as e:
+        logging.error(f"Failed to send error message to chat {message.chat.id}: {e}")
+
+@timed("telegram_download")
+async def download_to_memory(file_id: str) -> tuple[bytes, str]:
+    # Скачиваем файл из Telegram в память, без временных файлов на диске
+    file_info = await application.bot.get_file(file_id)
+    file_buffer = await application.bot.download_file(file_info.file_path)
+    return file_buffer.getvalue(), file_info.file_path
+
+def pick_photo_size(photo_sizes, max_side: int):
+    # Telegram присылает несколько размеров фото по возрастанию: берем самый маленький,
+    # который покрывает нужное разрешение, вместо самого большого
+    for photo in photo_sizes:
+        if max(photo.width, photo.height) >= max_side:
+            return photo
+    return photo_sizes[-1]
 
-async def send_bot_voice_response(message, response_audio_file):
+async def send_cached_voice(message, cache_key) -> bool:
+    # Если это аудио уже загружалось в Telegram, отправляем его по file_id без повторной загрузки
+    file_id = await tts_cache.get_file_id(cache_key)
+    if not file_id:
+        return False
+    try:
+        await send_queue.send(message.chat.id, lambda: application.bot.send_voice(message.chat.id, voice=file_id))
+        return True
+    except TelegramRetryAfter:
+        raise
+    except Exception as e:
+        logging.warning(f"Failed to send cached voice {file_id}: {e}")
+        return False
+
+async def send_bot_voice_response(message, response_audio_file, cache_key=None):
     if (response_audio_file):
         try:
-            # Save the audio file to disk
-            response_audio_path = str(uuid4())+"_response.ogg"
-            with open(response_audio_path, "wb") as response_file:
-                response_file.write(response_audio_file)
+            # Send the voice message straight from memory
+            voice = BufferedInputFile(response_audio_file, filename="response.ogg")
 
-            # Send the voice message
-            await bot.send_voice(message.chat.id, voice=FSInputFile(response_audio_path))
+            async def upload():
+                # Время в очереди отправки учитывается отдельно, здесь — только сама загрузка
+                async with timed("telegram_upload"):
+                    return await application.bot.send_voice(message.chat.id, voice=voice)
 
-            # Clean up the saved audio file
-            remove(response_audio_path)
+            sent_message = await send_queue.send(message.chat.id, upload, size=len(response_audio_file))
+            if cache_key and sent_message.voice:
+                await tts_cache.set_file_id(cache_key, sent_message.voice.file_id)
         except Exception as e:
             await handle_exception(message, e)
 
+async def send_text_reply(message, response_text):
+    # Синтез речи недоступен — отвечаем хотя бы текстом
+    try:
+        await send_queue.send(message.chat.id, lambda: message.answer(response_text), size=len(response_text))
+    except Exception as e:
+        await handle_exception(message, e)
 
-@dp.message(lambda message: message.content_type == ContentType.PHOTO)
-async def handle_photo_message(message: types.Message):
+async def send_bot_voice_reply(message, response_text):
+    if not response_text:
+        return
+    if not settings.TTS_STREAMING:
+        cache_key = tts_cache_key(response_text)
+        if await send_cached_voice(message, cache_key):
+            return
+        response_audio_file = await get_tts_response(response_text)
+        if response_audio_file is None:
+            await send_text_reply(message, response_text)
+            return
+        await send_bot_voice_response(message, response_audio_file, cache_key)
+        return
+    # Отправляем ответ по частям, не дожидаясь синтеза всего текста
+    started = perf_counter()
+    sent = 0
+    async for chunk_text, response_audio_file in stream_tts_response(response_text):
+        if response_audio_file is None:
+            await send_text_reply(message, chunk_text)
+            return
+        cache_key = tts_cache_key(chunk_text)
+        if not await send_cached_voice(message, cache_key):
+            await send_bot_voice_response(message, response_audio_file, cache_key)
+        sent += 1
+        if sent == 1:
+            logging.info(f"First voice chunk sent to chat {message.chat.id} in {perf_counter() - started:.2f}s")
+    if not sent:
+        await send_text_reply(message, response_text)
+        return
+    logging.info(f"Voice reply ({sent} chunks) sent to chat {message.chat.id} in {perf_counter() - started:.2f}s")
+
+async def get_photo_mood(photo):
+    # Сначала ищем по file_unique_id, затем по перцептивному хэшу; ответ озвучивается
+    # через send_bot_voice_reply, так что готовое аудио берется из кэша TTS
+    mood = await mood_cache.get_by_file(photo.file_unique_id)
+    if mood is not None:
+        return mood
+    image_data, _ = await download_to_memory(photo.file_id)
+    image_hash = await mood_cache.image_hash(image_data)
+    if image_hash is not None:
+        mood = await mood_cache.get_by_hash(image_hash)
+    if mood is None:
+        #делаем запрос в gpt-4o 
+        mood = await get_mood(image_data)
+    if mood:
+        await mood_cache.set(photo.file_unique_id, image_hash, mood)
+    return mood
 
-    photo = message.photo[-1]
-    file_info = await bot.get_file(photo.file_id)
-    file_path = file_info.file_path    
-    file_extension = file_path.split('.')[-1]
 
-    unique_filename = f"{uuid4()}.{file_extension}"
-    await bot.download_file(file_path, unique_filename)  
-    #делаем запрос в gpt-4o 
-    mood = await get_mood(unique_filename) 
+@router.message(lambda message: message.content_type == ContentType.PHOTO)
+@in_flight("photo")
+async def handle_photo_message(message: types.Message):
+
+    photo = pick_photo_size(message.photo, settings.IMAGE_MAX_SIDE)
+    mood = await get_photo_mood(photo)
     if(mood):
         try:
-            response_audio_file=await get_tts_response(mood)
-            await send_bot_voice_response(message, response_audio_file)
+            await send_bot_voice_reply(message, mood)
             track_user_event('send_photo', message.from_user.id, {'mood': mood})
         except Exception as e:
             await handle_exception(message, e)
-    remove(unique_filename)
 
-@dp.message(Command("start"))
+@router.message(Command("start"))
+@in_flight("start")
 async def send_welcome_message(message: types.Message, state: FSMContext):
     
     user_message_text = "Say hello to me and describe what you can do"
-    response_audio_file= await get_assistant_response(message.chat.id, user_message_text, state)
-    await send_bot_voice_response(message, response_audio_file)
+    response_text = await turn_scheduler.submit(
+        message.chat.id, message.from_user.id, user_message_text, state, coalesce=False
+    )
+    await send_bot_voice_reply(message, response_text)
     track_user_event('user_started', message.from_user.id, {'command': 'start'})
 
-@dp.message(lambda message: message.content_type == ContentType.TEXT)
+@router.message(Command("values"))
+@in_flight("values")
+async def send_values_profile(message: types.Message):
+    # Список с датами удобнее читать, чем слушать, поэтому ответ текстом
+    try:
+        entries = await values_cache.get_profile(message.chat.id)
+    except Exception as e:
+        await handle_exception(message, e)
+        return
+    await send_text_reply(message, format_profile(entries))
+    track_user_event('values_requested', message.from_user.id, {'values': len(entries)})
+
+@router.message(lambda message: message.content_type == ContentType.TEXT)
+@in_flight("text")
 async def handle_text_message(message: types.Message, state: FSMContext):
-    response_audio_file=await get_assistant_response(message.chat.id, message.text,state)   
-    await send_bot_voice_response(message, response_audio_file)
+    response_text = await turn_scheduler.submit(message.chat.id, message.from_user.id, message.text, state)
+    await send_bot_voice_reply(message, response_text)
     track_user_event('send_text', message.from_user.id, {'text': message.text})
 
-@dp.message(lambda message: message.content_type == ContentType.VOICE)
+@router.message(lambda message: message.content_type == ContentType.VOICE)
+@in_flight("voice")
 async def handle_voice_message(message: types.Message, state: FSMContext):
     voice = message.voice
-    file_info = await bot.get_file(voice.file_id)
-    file_path = file_info.file_path
-    unique_filename = str(uuid4())+"_voice.ogg"
-    await bot.download_file(file_path, unique_filename)
-
-    user_message_text = await transcribe_audio_file(unique_filename)
-    response_audio_file=await get_assistant_response(message.chat.id, user_message_text,state)
-    await send_bot_voice_response(message, response_audio_file)
+    voice_data, _ = await download_to_memory(voice.file_id)
+
+    user_message_text = await transcribe_audio_file(voice_data)
+    if not user_message_text:
+        return
+    response_text = await turn_scheduler.submit(message.chat.id, message.from_user.id, user_message_text, state)
+    await send_bot_voice_reply(message, response_text)
     track_user_event('send_voice', message.from_user.id, {'transcription': user_message_text})
-    remove(unique_filename)
 
 
-async def main():
-    await dp.start_polling(bot)
-    
+async def run_webhook():
+    # Несколько процессов могут слушать один порт за балансировщиком; общее состояние — в RedisStorage,
+    # ходы одного чата в разных процессах разводит блокировка turn_scheduler в Redis
+    bot = application.bot
+    dp = application.dispatcher
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=settings.WEBHOOK_SECRET or None,
+    ).register(app, path=settings.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    stop = Event()
+    loop = get_running_loop()
+    # По SIGTERM (перезапуск процесса) выходим штатно, с дообработкой очередей
+    for signum in (SIGINT, SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        site = web.TCPSite(runner, settings.WEBAPP_HOST, settings.WEBAPP_PORT, reuse_port=True)
+        await site.start()
+        if settings.WEBHOOK_BASE_URL:
+            await bot.set_webhook(
+                settings.WEBHOOK_BASE_URL.rstrip('/') + settings.WEBHOOK_PATH,
+                secret_token=settings.WEBHOOK_SECRET or None,
+            )
+        logging.info(f"Webhook server listening on {settings.WEBAPP_HOST}:{settings.WEBAPP_PORT}{settings.WEBHOOK_PATH}")
+        await stop.wait()
+    finally:
+        for signum in (SIGINT, SIGTERM):
+            loop.remove_signal_handler(signum)
+        await runner.cleanup()
+
+async def main(check: bool = False):
+    if check:
+        try:
+            return 0 if await application.check() else 1
+        finally:
+            await application.shutdown()
+    await application.startup()
+    try:
+        if settings.BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await application.dispatcher.start_polling(application.bot)
+    finally:
+        await application.shutdown()
+
 
 if __name__ == '__main__':
-    asyncio_run(main())
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument("--check", action="store_true", help="check settings and connections, then exit")
+    sys.exit(asyncio_run(main(parser.parse_args().check)))
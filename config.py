@@ -1,15 +1,200 @@
 from pydantic_settings import BaseSettings
 
+# Без них бот не запустится; проверяются при старте и в bot.py --check, а не при импорте,
+# чтобы утилитам (temp.py, kb_sync.py, бенчмарки) хватало только своих настроек
+REQUIRED_SETTINGS = ("TELEGRAM_TOKEN", "OPENAI_API_KEY", "DATABASE_URL", "AMPLITUDE_API_KEY", "REDIS_URL", "ASSISTANT_ID")
+
 class Settings(BaseSettings):
-    TELEGRAM_TOKEN: str
-    OPENAI_API_KEY: str
-    DATABASE_URL: str
-    AMPLITUDE_API_KEY: str
-    REDIS_URL: str
-    REDIS_PORT: int
-    ASSISTANT_ID: str
+    TELEGRAM_TOKEN: str = ""
+    OPENAI_API_KEY: str = ""
+    DATABASE_URL: str = ""
+    AMPLITUDE_API_KEY: str = ""
+    REDIS_URL: str = ""
+    REDIS_PORT: int = 6379
+    ASSISTANT_ID: str = ""
+
+    # Opus transcode pool
+    OPUS_WORKERS: int = 2
+    OPUS_MAX_PENDING: int = 32
+
+    # Распознавание голосовых: "openai", "faster_whisper" или свой класс "module:ClassName"
+    TRANSCRIBE_BACKEND: str = "openai"
+    TRANSCRIBE_MODEL: str = "whisper-1"
+    # Обрезка тишины, 16 кГц моно и разбиение длинных записей на параллельно распознаваемые куски.
+    # Выключено: в bench_transcription.py выигрыша с whisper-1 пока нет (60 с: 5.28 с против 5.39 с),
+    # а CPU на подготовку тратится заметный
+    TRANSCRIBE_PREPROCESS: bool = False
+    TRANSCRIBE_SAMPLE_RATE: int = 16000
+    TRANSCRIBE_CHUNK_SECONDS: float = 30.0
+    TRANSCRIBE_MIN_CHUNK_SECONDS: float = 15.0
+    TRANSCRIBE_CONCURRENCY: int = 4
+    VAD_FRAME_MS: int = 30
+    VAD_THRESHOLD_DB: float = -50.0
+    VAD_PEAK_MARGIN_DB: float = 35.0
+    VAD_PADDING_MS: int = 300
+    # Свой пул процессов для подготовки голосовых, отдельно от Opus-пула TTS
+    SPEECH_WORKERS: int = 1
+    SPEECH_MAX_PENDING: int = 8
+    LOCAL_WHISPER_MODEL: str = "base"
+    LOCAL_WHISPER_COMPUTE_TYPE: str = "int8"
+    LOCAL_TRANSCRIBE_WORKERS: int = 1
+
+    # Streaming TTS: длинные ответы режутся по предложениям и отправляются частями
+    TTS_STREAMING: bool = False
+    TTS_FIRST_CHUNK_CHARS: int = 200
+    TTS_CHUNK_CHARS: int = 600
+    TTS_STREAM_LOOKAHEAD: int = 2
+
+    # Кэш TTS: локальный LRU + Redis
+    TTS_CACHE_TTL: int = 7 * 24 * 3600
+    TTS_CACHE_LOCAL_MAX_BYTES: int = 32 * 1024 * 1024
+    TTS_CACHE_MAX_ENTRY_BYTES: int = 2 * 1024 * 1024
+
+    # Фоновая проверка жизненных ценностей
+    VALUE_VALIDATION_WORKERS: int = 2
+    VALUE_VALIDATION_QUEUE_SIZE: int = 1000
+    VALUE_VALIDATION_CONCURRENCY: int = 4
+    VALUE_VERDICT_CACHE_SIZE: int = 10000
+
+    # Очередь исходящих сообщений Telegram: ~30 сообщений/с на бота и ~1/с в один чат;
+    # за любую секунду уходит не больше burst + rate сообщений
+    SEND_GLOBAL_RATE: float = 25.0
+    SEND_GLOBAL_BURST: int = 5
+    SEND_CHAT_RATE: float = 1.0
+    SEND_CHAT_BURST: int = 2
+    SEND_MAX_QUEUE: int = 1000
+    # Ответы не больше этого размера (текст, короткое голосовое) обслуживаются первыми
+    SEND_SHORT_BYTES: int = 64 * 1024
+    SEND_MAX_RETRIES: int = 3
+    SEND_CHAT_BUCKETS: int = 10000
+
+    # Планировщик ходов ассистента
+    TURN_MAX_CONCURRENCY: int = 16
+    TURN_PER_USER_CONCURRENCY: int = 2
+    TURN_COALESCE: bool = True
+    TURN_COALESCE_WINDOW: float = 0.0
+    # Блокировка чата в Redis на время хода (только в режиме webhook): очередь выше живет внутри
+    # одного процесса, а обновления одного чата могут прийти в разные. Не дождавшись ее, ход падает
+    TURN_LOCK_TIMEOUT: float = 300.0
+    TURN_LOCK_WAIT: float = 120.0
+
+    # Режим получения обновлений: "polling" или "webhook"
+    BOT_MODE: str = "polling"
+    WEBHOOK_BASE_URL: str = ""
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: str = ""
+    WEBAPP_HOST: str = "0.0.0.0"
+    WEBAPP_PORT: int = 8080
+
+    # Отправка событий в Amplitude
+    AMPLITUDE_ENDPOINT: str = "https://api2.amplitude.com/batch"
+    AMPLITUDE_BUFFER_SIZE: int = 10000
+    AMPLITUDE_BATCH_SIZE: int = 100
+    AMPLITUDE_FLUSH_INTERVAL: float = 5.0
+    AMPLITUDE_SPILL_PATH: str = ""
+
+    # Подготовка фото для gpt-4o: в режиме detail=low модели хватает 512px
+    IMAGE_MAX_SIDE: int = 512
+    IMAGE_JPEG_QUALITY: int = 85
+    IMAGE_DETAIL: str = "low"
+
+    # Кэш настроения по фото
+    MOOD_CACHE_TTL: int = 30 * 24 * 3600
+    MOOD_CACHE_LOCAL_MAX_BYTES: int = 4 * 1024 * 1024
+    # Расстояние Хэмминга для почти-дубликатов; полос 4, поэтому больше 3 не бывает
+    MOOD_CACHE_MAX_DISTANCE: int = 3
+    # Сколько последних хэшей хранит одна полоса
+    MOOD_CACHE_BAND_SIZE: int = 256
+
+    FILE_NAME_CACHE_SIZE: int = 1024
+
+    # Реестр потоков ассистента: 0 отключает ротацию по возрасту / числу ходов
+    THREAD_CACHE_SIZE: int = 10000
+    THREAD_TTL: int = 0
+    THREAD_MAX_TURNS: int = 0
+    # Сколько секунд процесс верит своей копии thread_id, не сверяясь с Redis
+    THREAD_LOCAL_TTL: float = 30.0
+
+    # Контекст разговора: "full" (вся история потока), "truncate" (ограничения на run)
+    # или "summarize" (ограничения + сжатие истории в новый поток)
+    CONTEXT_MODE: str = "full"
+    RUN_MAX_PROMPT_TOKENS: int = 8000
+    RUN_LAST_MESSAGES: int = 20
+    SUMMARY_TRIGGER_TOKENS: int = 6000
+    SUMMARY_MODEL: str = "gpt-4o-mini"
+    SUMMARY_MAX_MESSAGES: int = 100
+    SUMMARY_MAX_TOKENS: int = 500
+    USER_VALUES_CONTEXT: bool = True
+    USER_VALUES_CONTEXT_LIMIT: int = 20
+
+    # Пулы HTTP-соединений для OpenAI, Telegram и Amplitude
+    HTTP_MAX_CONNECTIONS: int = 100
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_KEEPALIVE_EXPIRY: float = 60.0
+    HTTP2: bool = True
+    HTTP_CONNECT_TIMEOUT: float = 5.0
+    HTTP_READ_TIMEOUT: float = 60.0
+    HTTP_CONNECT_RETRIES: int = 2
+    HTTP_MAX_RETRIES: int = 2
+
+    # Устойчивость вызовов OpenAI: таймауты по наблюдаемым задержкам, повторы, hedging, circuit breaker
+    RESILIENCE_ENABLED: bool = True
+    RESILIENCE_MAX_ATTEMPTS: int = 3
+    RESILIENCE_BACKOFF_BASE: float = 0.5
+    RESILIENCE_BACKOFF_MAX: float = 8.0
+    RESILIENCE_TIMEOUT_MULTIPLIER: float = 3.0
+    RESILIENCE_MIN_TIMEOUT: float = 2.0
+    RESILIENCE_LATENCY_WINDOW: int = 200
+    RESILIENCE_HEDGE: bool = True
+    RESILIENCE_HEDGE_QUANTILE: float = 0.95
+    BREAKER_FAILURE_THRESHOLD: int = 5
+    BREAKER_RESET_TIMEOUT: float = 30.0
+    # Сколько ждать, пока отмененный run дойдет до конечного статуса, прежде чем повторять
+    RUN_CANCEL_TIMEOUT: float = 15.0
+
+    # Метрики Prometheus
+    METRICS_ENABLED: bool = False
+    METRICS_HOST: str = "0.0.0.0"
+    METRICS_PORT: int = 9100
+    DB_ECHO: bool = False
+
+    # Пул соединений с Postgres
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    # Кэш подготовленных выражений asyncpg на соединение (0 — выключить, нужно за pgbouncer)
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_QUERY_CACHE_SIZE: int = 500
+
+    # Профиль ценностей пользователя (values_profile.py): локальная копия живет недолго,
+    # потому что запись в другом процессе сбрасывает только Redis
+    VALUES_CACHE_SIZE: int = 10000
+    VALUES_CACHE_TTL: int = 24 * 3600
+    VALUES_LOCAL_TTL: float = 30.0
+    VALUES_TOP_TTL: int = 300
+    VALUES_EXPORT_BATCH: int = 5000
+
+    # Синхронизация базы знаний ассистента (kb_sync.py)
+    KB_DOCUMENTS_DIR: str = "knowledge_base"
+    KB_VECTOR_STORE_ID: str = ""
+    KB_VECTOR_STORE_NAME: str = "knowledge_base"
+    KB_SYNC_CONCURRENCY: int = 4
+
+    # Альтернативные адреса API (локальные заглушки для бенчмарков)
+    OPENAI_BASE_URL: str = ""
+    TELEGRAM_API_BASE: str = ""
     
+    # Сколько ждать дообработки очередей при остановке
+    SHUTDOWN_TIMEOUT: float = 10.0
+
     class Config:
         env_file = '.env'
 
+    def require(self, *names: str):
+        missing = [name for name in names if not getattr(self, name)]
+        if missing:
+            raise RuntimeError(f"Missing required settings: {', '.join(missing)}")
+
 settings = Settings()
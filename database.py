@@ -1,36 +1,150 @@
 import logging
 
+from typing import Optional
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
 from models import UserValue
 from config import settings
+from metrics import timed
 
-DATABASE_URL = settings.DATABASE_URL
+engine = None
+AsyncSessionLocal = None
+# Вызываются после записи ценностей с множеством затронутых user_id (сброс кэшей чтения)
+values_written_hooks = []
 
-engine = create_async_engine(DATABASE_URL, echo=True, future=True, pool_pre_ping=True)
-AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+def get_session_factory():
+    # Движок и пул создаются при первом запросе к базе, а не при импорте
+    global engine, AsyncSessionLocal
+    if AsyncSessionLocal is None:
+        settings.require("DATABASE_URL")
+        engine = create_async_engine(
+            settings.DATABASE_URL,
+            echo=settings.DB_ECHO,
+            future=True,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+            pool_pre_ping=settings.DB_POOL_PRE_PING,
+            query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+            # Повторные INSERT/SELECT используют уже подготовленные на соединении выражения
+            connect_args={"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE},
+        )
+        AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    return AsyncSessionLocal
+
+async def ping_database():
+    # Открывает первое соединение пула
+    async with get_session_factory()() as session:
+        await session.execute(text("SELECT 1"))
+
+async def dispose_engine():
+    global engine, AsyncSessionLocal
+    if engine is not None:
+        await engine.dispose()
+    engine = None
+    AsyncSessionLocal = None
 
 async def get_db():
-    async with AsyncSessionLocal() as session:
+    async with get_session_factory()() as session:
         yield session
 
-async def save_user_value(user_id: int, value: str):
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
+def upsert_values_statement(rows: list, table=UserValue.__table__):
+    # Одна вставка с ON CONFLICT по уникальному индексу (user_id, value); table подменяет бенчмарк
+    statement = pg_insert(table).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=["user_id", "value"],
+        set_={"created_date": statement.excluded.created_date}
+    )
+
+class UnitOfWork:
+    # Копит записи за ход (или пачку ходов) и выполняет их одной транзакцией при выходе из блока:
+    #   async with UnitOfWork() as uow:
+    #       uow.add_values(user_id, values)
+    def __init__(self):
+        self._user_values = {}
+
+    def add_values(self, user_id: int, values: list[str]):
+        for value in values:
+            # Одна строка на пару: ON CONFLICT не может обновить одну запись дважды за выражение
+            self._user_values[(user_id, value)] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            await self.commit()
+
+    @timed("db_write")
+    async def commit(self):
+        if not self._user_values:
+            return
+        rows = [{"user_id": user_id, "value": value} for user_id, value in self._user_values]
+        statement = upsert_values_statement(rows)
+        async with get_session_factory()() as session:
             try:
-                # Удаляем все записи с аналогичным значением value для данного user_id
-                await session.execute(
-                    UserValue.__table__.delete().where(UserValue.user_id == user_id, UserValue.value == value)
-                )
-                logging.info(f"Удалены все записи для user_id: {user_id} с значением: {value}.")
-
-                # Добавляем новое значение пользователя
-                new_user_value = UserValue(user_id=user_id, value=value)
-                session.add(new_user_value)
-                await session.commit()
-                logging.info(f"Значение {value} сохранено для user_id: {user_id}.")
+                async with session.begin():
+                    await session.execute(statement)
+                logging.info(f"Сохранено значений: {len(rows)}.")
             except Exception as e:
-                logging.error(f"Ошибка при сохранении значения для user_id: {user_id}. Ошибка: {e}")
-                await session.rollback()
+                logging.error(f"Ошибка при сохранении значений: {rows}. Ошибка: {e}")
                 raise
+        user_ids = {user_id for user_id, _ in self._user_values}
+        self._user_values.clear()
+        for hook in values_written_hooks:
+            try:
+                await hook(user_ids)
+            except Exception as e:
+                logging.warning(f"Values write hook failed: {e}")
+
+async def save_user_value(user_id: int, value: str):
+    await save_user_values(user_id, [value])
+
+async def save_user_values(user_id: int, values: list[str]):
+    async with UnitOfWork() as uow:
+        uow.add_values(user_id, values)
+
+@timed("db_read")
+async def get_user_value_profile(user_id: int) -> list:
+    # (value, first_seen_date, created_date) по пользователю, последние упоминания первыми
+    statement = (
+        select(UserValue.value, UserValue.first_seen_date, UserValue.created_date)
+        .where(UserValue.user_id == user_id)
+        .order_by(UserValue.created_date.desc(), UserValue.id.desc())
+    )
+    async with get_session_factory()() as session:
+        result = await session.execute(statement)
+        return [tuple(row) for row in result]
+
+@timed("db_read")
+async def get_top_values(limit: int) -> list:
+    # (value, число пользователей, первое и последнее упоминание) по всей таблице;
+    # это полный проход, поэтому результат кэшируется (values_profile.values_cache)
+    users = func.count().label("users")
+    statement = (
+        select(UserValue.value, users, func.min(UserValue.first_seen_date), func.max(UserValue.created_date))
+        .group_by(UserValue.value)
+        .order_by(users.desc(), UserValue.value)
+        .limit(limit)
+    )
+    async with get_session_factory()() as session:
+        result = await session.execute(statement)
+        return [tuple(row) for row in result]
+
+async def iter_user_values(batch_size: int, user_id: Optional[int] = None):
+    # Серверный курсор: строки приходят пачками по batch_size, таблица целиком в память не читается
+    statement = (
+        select(UserValue.user_id, UserValue.value, UserValue.first_seen_date, UserValue.created_date)
+        .order_by(UserValue.user_id, UserValue.value)
+        .execution_options(yield_per=batch_size)
+    )
+    if user_id is not None:
+        statement = statement.where(UserValue.user_id == user_id)
+    async with get_session_factory()() as session:
+        result = await session.stream(statement)
+        async for partition in result.partitions():
+            yield [tuple(row) for row in partition]
@@ -0,0 +1,69 @@
+import logging
+
+from collections import OrderedDict
+
+from config import settings
+from metrics import register_collector
+
+FILE_NAMES_KEY = "openai:file_names"
+
+
+class FileNameCache:
+    # file_id -> filename для цитат из vector store; имена файлов не меняются, поэтому без TTL
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.redis = None
+        self.hits = 0
+        self.misses = 0
+        self._names = OrderedDict()
+
+    def setup(self, redis):
+        self.redis = redis
+
+    async def get_many(self, file_ids: list[str]) -> dict:
+        found = {}
+        missing = []
+        for file_id in file_ids:
+            if file_id in self._names:
+                self._names.move_to_end(file_id)
+                found[file_id] = self._names[file_id]
+            else:
+                missing.append(file_id)
+        if missing and self.redis is not None:
+            try:
+                names = await self.redis.hmget(FILE_NAMES_KEY, missing)
+            except Exception as e:
+                logging.warning(f"File name cache read failed: {e}")
+                names = [None] * len(missing)
+            for file_id, name in zip(missing, names):
+                if name is not None:
+                    found[file_id] = name.decode('utf-8')
+                    self._remember(file_id, found[file_id])
+        self.hits += len(found)
+        self.misses += len(file_ids) - len(found)
+        return found
+
+    async def set_many(self, names: dict):
+        if not names:
+            return
+        for file_id, name in names.items():
+            self._remember(file_id, name)
+        if self.redis is not None:
+            try:
+                await self.redis.hset(FILE_NAMES_KEY, mapping=names)
+            except Exception as e:
+                logging.warning(f"File name cache write failed: {e}")
+
+    def _remember(self, file_id: str, name: str):
+        self._names[file_id] = name
+        self._names.move_to_end(file_id)
+        while len(self._names) > self.max_entries:
+            self._names.popitem(last=False)
+
+
+file_name_cache = FileNameCache(max_entries=settings.FILE_NAME_CACHE_SIZE)
+register_collector(
+    "bot_file_name_cache",
+    lambda: {(): {"hits": file_name_cache.hits, "misses": file_name_cache.misses}},
+    "OpenAI file name cache",
+)
@@ -0,0 +1,122 @@
+from asyncio import gather
+from collections import defaultdict
+from time import perf_counter
+from typing import Optional
+
+import httpx
+
+from aiohttp import TraceConfig
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
+from openai import AsyncOpenAI
+
+from config import settings
+from metrics import register_collector
+
+# Статистика переиспользования соединений по хостам: сколько запросов и сколько новых соединений
+connection_stats = defaultdict(lambda: {"requests": 0, "connections": 0})
+
+
+def get_connection_stats() -> dict:
+    return {
+        host: {
+            **stats,
+            "reuse_ratio": 1 - stats["connections"] / stats["requests"] if stats["requests"] else 0.0,
+        }
+        for host, stats in connection_stats.items()
+    }
+
+
+register_collector(
+    "bot_http",
+    lambda: {("host", host): stats for host, stats in get_connection_stats().items()},
+    "Outbound HTTP connection reuse",
+)
+
+
+async def _trace_httpx(request: httpx.Request):
+    host = request.url.host
+
+    async def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            connection_stats[host]["connections"] += 1
+        elif event_name.endswith("send_request_headers.started"):
+            connection_stats[host]["requests"] += 1
+
+    request.extensions["trace"] = trace
+
+
+def create_http_client(**kwargs) -> httpx.AsyncClient:
+    # Общие настройки пула: keep-alive, HTTP/2, таймауты и повтор установки соединения
+    transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=settings.HTTP2,
+        retries=settings.HTTP_CONNECT_RETRIES,
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(settings.HTTP_READ_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT),
+        event_hooks={"request": [_trace_httpx]},
+        **kwargs
+    )
+
+
+def create_openai_client(max_retries: Optional[int] = None) -> AsyncOpenAI:
+    # Повторы с экспоненциальной задержкой и jitter выполняет сам SDK; если повторами
+    # управляет вызывающий код (resilience.py), их здесь нужно отключить (max_retries=0)
+    settings.require("OPENAI_API_KEY")
+    return AsyncOpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        base_url=settings.OPENAI_BASE_URL or None,
+        max_retries=settings.HTTP_MAX_RETRIES if max_retries is None else max_retries,
+        http_client=create_http_client(),
+    )
+
+
+class TracedAiohttpSession(AiohttpSession):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._trace_config = TraceConfig()
+        self._trace_config.on_request_start.append(self._on_request_start)
+        self._trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        self._trace_config.freeze()
+
+    async def create_session(self):
+        session = await super().create_session()
+        # aiogram не дает передать trace_configs при создании ClientSession
+        if self._trace_config not in session._trace_configs:
+            session._trace_configs.append(self._trace_config)
+        return session
+
+    @staticmethod
+    async def _on_request_start(session, context, params):
+        context.host = params.url.host
+        connection_stats[context.host]["requests"] += 1
+
+    @staticmethod
+    async def _on_connection_create_end(session, context, params):
+        connection_stats[getattr(context, "host", "unknown")]["connections"] += 1
+
+
+def create_telegram_session() -> AiohttpSession:
+    api = TelegramAPIServer.from_base(settings.TELEGRAM_API_BASE) if settings.TELEGRAM_API_BASE else PRODUCTION
+    return TracedAiohttpSession(api=api, limit=settings.HTTP_MAX_CONNECTIONS, timeout=settings.HTTP_READ_TIMEOUT)
+
+
+async def warm_up(checks: dict) -> dict:
+    # Открываем соединения заранее и параллельно, чтобы первый пользователь не платил за TLS handshake.
+    # checks — {имя: фабрика корутины}, результат — {имя: (секунды, ошибка или None)}
+    async def run(factory):
+        started = perf_counter()
+        try:
+            await factory()
+        except Exception as e:
+            return perf_counter() - started, e
+        return perf_counter() - started, None
+
+    results = await gather(*(run(factory) for factory in checks.values()))
+    return dict(zip(checks, results))
@@ -0,0 +1,235 @@
+import argparse
+import logging
+import os
+import sys
+
+from asyncio import Semaphore, gather, run as asyncio_run, to_thread
+from dataclasses import dataclass, field
+from hashlib import sha256
+
+from config import settings
+from http_clients import create_openai_client
+
+# Форматы, которые понимает file_search
+KB_EXTENSIONS = {".c", ".cpp", ".css", ".doc", ".docx", ".go", ".html", ".java", ".js", ".json", ".md",
+                 ".pdf", ".php", ".pptx", ".py", ".rb", ".sh", ".tex", ".ts", ".txt"}
+KB_INSTRUCTIONS = (
+    "Always look for information using the `file_search` tool before giving an answer. "
+    "If `file_search` does not return relevant information, proceed with your own knowledge."
+)
+# По этой строке находится блок про file_search, дописанный раньше (в том числе старым update_assistant)
+KB_INSTRUCTIONS_MARKER = "Always look for information using the `file_search` tool"
+
+
+@dataclass
+class LocalDocument:
+    path: str
+    digest: str
+
+
+@dataclass
+class RemoteDocument:
+    file_id: str
+    digest: str
+
+
+@dataclass
+class SyncPlan:
+    upload: list = field(default_factory=list)
+    delete: list = field(default_factory=list)
+    # путь -> file_id старой версии; удаляется только после индексации новой
+    replace: dict = field(default_factory=dict)
+    unchanged: int = 0
+    failed: list = field(default_factory=list)
+
+
+def file_digest(path: str) -> str:
+    digest = sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_documents(directory: str) -> dict:
+    # Ключ — путь относительно каталога: по нему сопоставляются локальные и загруженные файлы
+    documents = {}
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            if os.path.splitext(name)[1].lower() not in KB_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            key = os.path.relpath(path, directory).replace(os.sep, "/")
+            documents[key] = LocalDocument(path, file_digest(path))
+    return documents
+
+
+def plan_sync(local: dict, remote: dict) -> SyncPlan:
+    plan = SyncPlan()
+    for key, document in local.items():
+        current = remote.get(key)
+        if current is not None and current.digest == document.digest:
+            plan.unchanged += 1
+        else:
+            plan.upload.append(key)
+            if current is not None:
+                plan.replace[key] = current.file_id
+    plan.delete = [document.file_id for key, document in remote.items() if key not in local]
+    return plan
+
+
+def desired_instructions(instructions: str) -> str:
+    base = (instructions or "").split(KB_INSTRUCTIONS_MARKER, 1)[0].rstrip()
+    return f"{base}\n\n{KB_INSTRUCTIONS}" if base else KB_INSTRUCTIONS
+
+
+def desired_tools(tools) -> list:
+    # Ровно один file_search; остальные инструменты не трогаем
+    result = []
+    file_search = None
+    for tool in tools:
+        if tool.type == "file_search":
+            file_search = file_search or tool.model_dump(exclude_none=True)
+        else:
+            result.append(tool.model_dump(exclude_none=True))
+    return result + [file_search or {"type": "file_search"}]
+
+
+class KnowledgeBaseSync:
+    def __init__(self, client, assistant_id: str, directory: str, concurrency: int, dry_run: bool = False):
+        self.client = client
+        self.assistant_id = assistant_id
+        self.directory = directory
+        self.concurrency = concurrency
+        self.dry_run = dry_run
+
+    async def run(self):
+        assistant = await self.client.beta.assistants.retrieve(self.assistant_id)
+        vector_store_id = await self._vector_store_id(assistant)
+        local = await to_thread(scan_documents, self.directory)
+        remote, broken = await self._remote_documents(vector_store_id) if vector_store_id else ({}, [])
+        plan = plan_sync(local, remote)
+        plan.delete.extend(broken)
+        logging.info(
+            f"Knowledge base {self.directory}: {len(local)} files, {plan.unchanged} unchanged, "
+            f"{len(plan.upload)} to upload, {len(plan.delete) + len(plan.replace)} to delete"
+        )
+        if self.dry_run:
+            return plan
+        if vector_store_id is None:
+            vector_store = await self.client.vector_stores.create(name=settings.KB_VECTOR_STORE_NAME)
+            vector_store_id = vector_store.id
+            logging.info(f"Created vector store {vector_store_id}")
+        slots = Semaphore(self.concurrency)
+        indexed = await gather(*(self._upload(slots, vector_store_id, key, local[key]) for key in plan.upload))
+        # Старая версия удаляется, только если новая проиндексирована, чтобы поиск не оставался без файла
+        stale = plan.delete + [
+            plan.replace[key] for key, ok in zip(plan.upload, indexed) if ok and key in plan.replace
+        ]
+        plan.failed = [key for key, ok in zip(plan.upload, indexed) if not ok]
+        await gather(*(self._delete(slots, vector_store_id, file_id) for file_id in stale))
+        await self._update_assistant(assistant, vector_store_id)
+        if plan.failed:
+            logging.error(f"Failed to upload {len(plan.failed)} file(s): {', '.join(plan.failed)}")
+        return plan
+
+    async def _vector_store_id(self, assistant):
+        if settings.KB_VECTOR_STORE_ID:
+            return settings.KB_VECTOR_STORE_ID
+        # Переиспользуем хранилище, уже подключенное к ассистенту
+        file_search = getattr(assistant.tool_resources, "file_search", None)
+        vector_store_ids = getattr(file_search, "vector_store_ids", None) or []
+        return vector_store_ids[0] if vector_store_ids else None
+
+    async def _remote_documents(self, vector_store_id: str):
+        documents = {}
+        broken = []
+        async for item in self.client.vector_stores.files.list(vector_store_id=vector_store_id, limit=100):
+            attributes = item.attributes or {}
+            key = attributes.get("path")
+            # Файлы без атрибутов (загруженные старым скриптом), с ошибкой индексации
+            # и дубли одного пути перезаливаются
+            if item.status == "failed" or not key or key in documents:
+                broken.append(item.id)
+            else:
+                documents[key] = RemoteDocument(item.id, attributes.get("sha256", ""))
+        return documents, broken
+
+    async def _upload(self, slots, vector_store_id: str, key: str, document: LocalDocument) -> bool:
+        # Ошибка одного файла не прерывает синхронизацию: его старая версия просто остается
+        async with slots:
+            uploaded = None
+            try:
+                with open(document.path, "rb") as file:
+                    uploaded = await self.client.files.create(file=(os.path.basename(key), file), purpose="assistants")
+                item = await self.client.vector_stores.files.create_and_poll(
+                    vector_store_id=vector_store_id,
+                    file_id=uploaded.id,
+                    attributes={"path": key, "sha256": document.digest},
+                )
+                error = None if item.status == "completed" else item.last_error
+            except Exception as e:
+                error = e
+            if error is None:
+                logging.info(f"Uploaded {key} as {uploaded.id}")
+                return True
+            logging.error(f"Failed to index {key}: {error}")
+            if uploaded is not None:
+                try:
+                    await self.client.files.delete(uploaded.id)
+                except Exception as e:
+                    logging.warning(f"Failed to delete file {uploaded.id} of {key}: {e}")
+            return False
+
+    async def _delete(self, slots, vector_store_id: str, file_id: str):
+        async with slots:
+            try:
+                await self.client.vector_stores.files.delete(file_id=file_id, vector_store_id=vector_store_id)
+                await self.client.files.delete(file_id)
+                logging.info(f"Deleted stale file {file_id}")
+            except Exception as e:
+                logging.warning(f"Failed to delete stale file {file_id}: {e}")
+
+    async def _update_assistant(self, assistant, vector_store_id: str):
+        instructions = desired_instructions(assistant.instructions)
+        tools = desired_tools(assistant.tools)
+        current_store_ids = getattr(getattr(assistant.tool_resources, "file_search", None), "vector_store_ids", None)
+        # Лишнее обновление ничего не ломает, но каждое изменение промпта и инструментов
+        # сказывается на длине и времени каждого run-а — поэтому только при расхождении
+        if (instructions == assistant.instructions
+                and tools == [tool.model_dump(exclude_none=True) for tool in assistant.tools]
+                and current_store_ids == [vector_store_id]):
+            logging.info(f"Assistant {assistant.id} is up to date")
+            return
+        await self.client.beta.assistants.update(
+            assistant_id=assistant.id,
+            instructions=instructions,
+            tools=tools,
+            tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}},
+        )
+        logging.info(f"Updated assistant {assistant.id}")
+
+
+async def sync_knowledge_base(assistant_id: str = None, directory: str = None, dry_run: bool = False) -> SyncPlan:
+    client = create_openai_client()
+    try:
+        return await KnowledgeBaseSync(
+            client,
+            assistant_id or settings.ASSISTANT_ID,
+            directory or settings.KB_DOCUMENTS_DIR,
+            settings.KB_SYNC_CONCURRENCY,
+            dry_run,
+        ).run()
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Sync the documents directory into the assistant's vector store")
+    parser.add_argument("--dir", help=f"documents directory (default: {settings.KB_DOCUMENTS_DIR})")
+    parser.add_argument("--assistant-id", help="assistant to update (default: ASSISTANT_ID)")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    args = parser.parse_args()
+    plan = asyncio_run(sync_knowledge_base(args.assistant_id, args.dir, args.dry_run))
+    sys.exit(1 if plan.failed else 0)
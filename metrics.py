@@ -0,0 +1,265 @@
+import logging
+
+from bisect import bisect_left
+from dataclasses import fields
+from functools import wraps
+from inspect import isasyncgenfunction, iscoroutinefunction
+from time import perf_counter
+
+from aiohttp import web
+
+from config import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Поля коллекторов с текущим значением; остальные только растут и отдаются как counter
+GAUGE_FIELDS = {"queued", "queue_depth", "in_flight", "breaker_state", "timeout_seconds", "reuse_ratio",
+                "hit_rate", "redis_ops_per_lookup"}
+
+
+def _format_labels(label_names, label_values, extra=None) -> str:
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name + _format_labels(self.label_names, key), value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [счетчики по бакетам..., +Inf], сумма
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket" + _format_labels(self.label_names, key, ("le", bound)), cumulative
+            yield self.name + "_sum" + _format_labels(self.label_names, key), total
+            yield self.name + "_count" + _format_labels(self.label_names, key), cumulative
+
+
+registry = []
+# Источники уже существующей статистики модулей (dataclass-ы со счетчиками)
+collectors = []
+
+STAGE_SECONDS = Histogram("bot_stage_seconds", "Time spent in each processing stage", ["stage"])
+ERRORS = Counter("bot_errors_total", "Errors by stage", ["stage"])
+RETRIES = Counter("bot_retries_total", "Retries by stage", ["stage"])
+IN_FLIGHT = Gauge("bot_handlers_in_flight", "Handlers currently running", ["handler"])
+TOKENS = Histogram(
+    "bot_assistant_tokens", "Tokens per assistant run", ["kind"],
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+
+
+def register_collector(prefix: str, collector, documentation: str = ""):
+    # collector возвращает dataclass со счетчиками или {(label_name, label_value): {field: value}};
+    # числовые поля экспортируются как gauge с префиксом
+    collectors.append((prefix, collector, documentation))
+
+
+def observe(stage: str, seconds: float):
+    if settings.METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def count_error(stage: str):
+    if settings.METRICS_ENABLED:
+        ERRORS.inc(stage=stage)
+
+
+def observe_tokens(prompt_tokens: int, completion_tokens: int):
+    if settings.METRICS_ENABLED:
+        TOKENS.observe(prompt_tokens, kind="prompt")
+        TOKENS.observe(completion_tokens, kind="completion")
+
+
+def count_retry(stage: str):
+    if settings.METRICS_ENABLED:
+        RETRIES.inc(stage=stage)
+
+
+class timed:
+    # Замер длительности этапа: декоратор (sync/async/async-генератор) или (async) контекстный менеджер.
+    # При выключенных метриках декоратор возвращает функцию без обертки
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self):
+        if settings.METRICS_ENABLED:
+            self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if settings.METRICS_ENABLED:
+            STAGE_SECONDS.observe(perf_counter() - self.started, stage=self.stage)
+            if exc_type is not None and issubclass(exc_type, Exception):
+                ERRORS.inc(stage=self.stage)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        return self.__exit__(exc_type, exc, traceback)
+
+    def __call__(self, func):
+        if not settings.METRICS_ENABLED:
+            return func
+        stage = self.stage
+        if isasyncgenfunction(func):
+            @wraps(func)
+            async def async_gen_wrapper(*args, **kwargs):
+                with timed(stage):
+                    async for item in func(*args, **kwargs):
+                        yield item
+            return async_gen_wrapper
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class in_flight:
+    __slots__ = ("handler",)
+
+    def __init__(self, handler: str):
+        self.handler = handler
+
+    def __call__(self, func):
+        if not settings.METRICS_ENABLED:
+            return func
+        handler = self.handler
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            IN_FLIGHT.inc(handler=handler)
+            try:
+                with timed(f"handler_{handler}"):
+                    return await func(*args, **kwargs)
+            finally:
+                IN_FLIGHT.dec(handler=handler)
+        return wrapper
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(f"{name} {value}" for name, value in metric.samples())
+    for prefix, source, documentation in collectors:
+        try:
+            lines.extend(_render_collected(prefix, source(), documentation))
+        except Exception as e:
+            logging.warning(f"Metrics collector {prefix} failed: {e}")
+    return "\n".join(lines) + "\n"
+
+
+def _render_collected(prefix, collected, documentation):
+    if isinstance(collected, dict):
+        rows = collected.items()
+    else:
+        values = {field.name: getattr(collected, field.name) for field in fields(collected)}
+        # Производные величины (доли попаданий и т.п.) объявлены в статистике свойствами
+        values.update(
+            (name, getattr(collected, name)) for name, attr in vars(type(collected)).items() if isinstance(attr, property)
+        )
+        rows = [((), values)]
+    grouped = {}
+    for label, values in rows:
+        for field_name, value in values.items():
+            if isinstance(value, (int, float)):
+                metric_type = "gauge" if _is_gauge(field_name) else "counter"
+                name = f"{prefix}_{field_name}"
+                if metric_type == "counter" and not name.endswith("_total"):
+                    name += "_total"
+                grouped.setdefault((name, metric_type), []).append(
+                    name + _format_labels(label[:1], label[1:]) + f" {value}"
+                )
+    for (name, metric_type), samples in grouped.items():
+        yield f"# HELP {name} {documentation}".rstrip()
+        yield f"# TYPE {name} {metric_type}"
+        yield from samples
+
+
+def _is_gauge(field_name: str) -> bool:
+    return field_name in GAUGE_FIELDS or field_name.endswith("_max")
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, settings.METRICS_HOST, settings.METRICS_PORT).start()
+    logging.info(f"Metrics available on {settings.METRICS_HOST}:{settings.METRICS_PORT}/metrics")
+    return runner
@@ -1,6 +1,5 @@
-from sqlalchemy import Column, Integer, String, Date
+from sqlalchemy import Column, Integer, String, Date, Index, func
 from sqlalchemy.orm import declarative_base
-from datetime import datetime
 
 Base = declarative_base()
 
@@ -10,4 +9,13 @@ class UserValue(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, nullable=False)
     value = Column(String(255), nullable=False)
-    created_date = Column(Date, nullable=False, default=datetime.utcnow().date())
+    # Дату ставит сама база при вставке, а не процесс при импорте модуля.
+    # created_date обновляется при каждом повторном упоминании (последнее упоминание),
+    # first_seen_date — только при первой вставке
+    created_date = Column(Date, nullable=False, server_default=func.current_date())
+    first_seen_date = Column(Date, nullable=False, server_default=func.current_date())
+
+    # Индекс по (user_id, value) обслуживает и выборки всех ценностей по user_id
+    __table_args__ = (
+        Index('ux_user_values_user_id_value', 'user_id', 'value', unique=True),
+    )
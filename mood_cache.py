@@ -0,0 +1,172 @@
+import logging
+
+from asyncio import to_thread
+from dataclasses import dataclass
+from io import BytesIO
+from time import time
+from typing import Optional
+
+from PIL import Image
+
+from config import settings
+from tts_cache import LocalLRU
+from metrics import register_collector
+
+FILE_PREFIX = "mood:file:"
+HASH_PREFIX = "mood:phash:"
+# Полосы — ZSET с временем записи в качестве score (раньше были SET-ы под mood:band:)
+BAND_PREFIX = "mood:bands:"
+# 64-битный хэш делится на 4 полосы по 16 бит: при расстоянии Хэмминга <= 3
+# хотя бы одна полоса у похожих изображений совпадает
+HASH_BANDS = 4
+
+
+def difference_hash(image_data: bytes) -> int:
+    # dHash: сравниваем яркость соседних пикселей уменьшенной серой копии 9x8
+    with Image.open(BytesIO(image_data)) as image:
+        pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    image_hash = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            image_hash = (image_hash << 1) | (left > right)
+    return image_hash
+
+
+def hash_bands(image_hash: int) -> list[str]:
+    return [f"{band}:{(image_hash >> (16 * band)) & 0xFFFF:04x}" for band in range(HASH_BANDS)]
+
+
+@dataclass
+class MoodCacheStats:
+    file_hits: int = 0
+    file_misses: int = 0
+    hash_hits: int = 0
+    near_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        # Каждое фото сначала ищется по file_unique_id, так что их число — знаменатель
+        photos = self.file_hits + self.file_misses
+        hits = self.file_hits + self.hash_hits + self.near_hits
+        return hits / photos if photos else 0.0
+
+
+class MoodCache:
+    def __init__(self, max_bytes: int, ttl: int, max_distance: int, band_size: int):
+        if max_distance > HASH_BANDS - 1:
+            logging.warning(f"Mood cache max distance {max_distance} clamped to {HASH_BANDS - 1}")
+            max_distance = HASH_BANDS - 1
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.band_size = band_size
+        self.local = LocalLRU(max_bytes, ttl)
+        self.redis = None
+        self.stats = MoodCacheStats()
+
+    def setup(self, redis):
+        self.redis = redis
+
+    async def get_by_file(self, file_unique_id: str) -> Optional[str]:
+        # Повторно отправленное или пересланное фото имеет тот же file_unique_id — скачивать не нужно
+        mood = await self._get(FILE_PREFIX + file_unique_id)
+        if mood is not None:
+            self.stats.file_hits += 1
+        else:
+            self.stats.file_misses += 1
+        return mood
+
+    async def image_hash(self, image_data: bytes) -> Optional[int]:
+        try:
+            return await to_thread(difference_hash, image_data)
+        except Exception as e:
+            logging.error(f"Failed to hash image: {e}")
+            return None
+
+    async def get_by_hash(self, image_hash: int) -> Optional[str]:
+        mood = await self._get(f"{HASH_PREFIX}{image_hash:016x}")
+        if mood is not None:
+            self.stats.hash_hits += 1
+            return mood
+        mood = await self._get_near_duplicate(image_hash)
+        if mood is not None:
+            self.stats.near_hits += 1
+            return mood
+        self.stats.misses += 1
+        return None
+
+    async def set(self, file_unique_id: str, image_hash: Optional[int], mood: str):
+        await self._set(FILE_PREFIX + file_unique_id, mood)
+        if image_hash is None:
+            return
+        await self._set(f"{HASH_PREFIX}{image_hash:016x}", mood)
+        if self.redis is None:
+            return
+        now = time()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for band in hash_bands(image_hash):
+                    key = BAND_PREFIX + band
+                    pipe.zadd(key, {f"{image_hash:016x}": now})
+                    # Хэши, чья запись в HASH_PREFIX уже истекла, и самые старые сверх band_size
+                    pipe.zremrangebyscore(key, "-inf", now - self.ttl)
+                    pipe.zremrangebyrank(key, 0, -self.band_size - 1)
+                    pipe.expire(key, self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            logging.warning(f"Mood cache write failed: {e}")
+
+    async def _get_near_duplicate(self, image_hash: int) -> Optional[str]:
+        if self.redis is None or not self.max_distance:
+            return None
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for band in hash_bands(image_hash):
+                    pipe.zrangebyscore(BAND_PREFIX + band, time() - self.ttl, "+inf")
+                bands = await pipe.execute()
+        except Exception as e:
+            logging.warning(f"Mood cache read failed: {e}")
+            return None
+        best = None
+        for candidate in set().union(*bands):
+            candidate_hash = int(candidate, 16)
+            distance = bin(candidate_hash ^ image_hash).count('1')
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, candidate_hash)
+        if best is None:
+            return None
+        return await self._get(f"{HASH_PREFIX}{best[1]:016x}")
+
+    async def _get(self, key: str) -> Optional[str]:
+        mood = self.local.get(key)
+        if mood is not None or self.redis is None:
+            return mood
+        try:
+            mood = await self.redis.get(key)
+        except Exception as e:
+            logging.warning(f"Mood cache read failed: {e}")
+            return None
+        if mood is not None:
+            mood = mood.decode('utf-8')
+            self.local.set(key, mood)
+        return mood
+
+    async def _set(self, key: str, mood: str):
+        self.local.set(key, mood)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(key, mood, ex=self.ttl)
+        except Exception as e:
+            logging.warning(f"Mood cache write failed: {e}")
+
+
+mood_cache = MoodCache(
+    max_bytes=settings.MOOD_CACHE_LOCAL_MAX_BYTES,
+    ttl=settings.MOOD_CACHE_TTL,
+    max_distance=settings.MOOD_CACHE_MAX_DISTANCE,
+    band_size=settings.MOOD_CACHE_BAND_SIZE,
+)
+register_collector("bot_mood_cache", lambda: mood_cache.stats, "Photo mood cache")
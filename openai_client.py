@@ -1,23 +1,57 @@
 import logging
 import json
+import re
 
-from asyncio import sleep as asyncio_sleep
-from openai import AsyncOpenAI, OpenAIError
+from asyncio import Queue, QueueFull, Semaphore, create_task, gather, shield, to_thread, wait_for, sleep as asyncio_sleep
+from asyncio import TimeoutError as AsyncioTimeoutError
+from collections import OrderedDict
+from time import perf_counter
+from openai import OpenAIError
 from aiogram.fsm.context import FSMContext
 
 from config import settings
-from some_utils import convert_to_ogg_opus, encode_image
-from database import save_user_value
+from some_utils import convert_to_ogg_opus, encode_image, prepare_speech, split_into_sentences, OpusStreamEncoder
+from database import UnitOfWork
+from values_profile import values_cache
+from tts_cache import tts_cache, make_tts_key
+from file_cache import file_name_cache
+from thread_registry import thread_registry
+from http_clients import create_openai_client
+from transcription import create_transcription_backend
+from resilience import CircuitOpenError, backoff_delay, endpoint
+from metrics import timed, count_error, count_retry, observe_tokens
 
-client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+client = None
 ASSISTANT_ID=settings.ASSISTANT_ID
+TTS_MODEL = "tts-1"
+TTS_VOICE = "alloy"
+FALLBACK_REPLY = "Sorry, I can't answer right now. Please try again in a minute."
 
 
-async def get_mood(file_path):
-    # Getting the base64 string
-    base64_image = await encode_image(file_path)
+def get_client():
+    # Клиент и его пул соединений создаются при первом запросе, а не при импорте
+    global client
+    if client is None:
+        # Повторами вызовов управляет resilience.py, повторы SDK поверх них только множат запросы
+        client = create_openai_client(max_retries=0 if settings.RESILIENCE_ENABLED else None)
+    return client
+
+async def close_client():
+    global client, transcription_backend
+    if client is not None:
+        await client.close()
+        client = None
+    transcription_backend = None
+
+
+@timed("vision_mood")
+async def get_mood(image_data: bytes):
+    # Getting the base64 string of the downscaled image
+    base64_image, mime_type = await encode_image(image_data, settings.IMAGE_MAX_SIDE, settings.IMAGE_JPEG_QUALITY)
+    if not base64_image:
+        return None
     try:
-        response = await client.chat.completions.create(
+        response = await endpoint("vision").call(lambda: get_client().chat.completions.create(
         model="gpt-4o",
         messages=[
             {
@@ -30,116 +64,472 @@ async def get_mood(file_path):
                 {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64_image}"
+                    "url": f"data:{mime_type};base64,{base64_image}",
+                    "detail": settings.IMAGE_DETAIL
                 }
                 }
             ]
             }
         ],
         max_tokens=300,
-        )
+        ), hedge=True)
         content = response.choices[0].message.content
         return str(content)
     except Exception as e:
-        logging.error("Failed to get mood:", e)
+        count_error("vision_mood")
+        logging.error(f"Failed to get mood: {e}")
         return None
     
-async def get_assistant_response(chat_id, user_message: str, state: FSMContext) -> str:
-    # Получаем текущее состояние пользователя
-    data = await state.get_data()
-    thread_id = data.get(str(chat_id))
-    # Если нет thread_id в состоянии, создаем новый поток
-    if not thread_id:
-        try:
-            thread = await client.beta.threads.create()
-            thread_id = thread.id
-            await state.update_data({str(chat_id): str(thread_id)})
-        except Exception as e:
-            logging.error(f"Failed to create thread for chat_id {chat_id}: {e}")
-            return None
-    try:
-        attempt_limit = 3
-        for attempt in range(attempt_limit):
-            await client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=user_message, 
-            )
-            run = await client.beta.threads.runs.create_and_poll(
-                thread_id=thread_id,
-                assistant_id=ASSISTANT_ID,
-                tool_choice="required"
-            )
-            if run.status == 'requires_action':
-                tool_outputs = []
-                userid_and_values = []
-                for tool in run.required_action.submit_tool_outputs.tool_calls:
-                    value_dict = json.loads(tool.function.arguments)
-                    values = value_dict.get('values', [])
-                    tool_outputs.append({
-                        "tool_call_id": tool.id,
-                        "output": tool.function.arguments
-                    })
-                    #отправятся на валидацию
-                    userid_and_values.append({
-                        "values": values,
-                        "chat_id": chat_id
-                    })
-                if tool_outputs:
-                    try:
-                        run = await client.beta.threads.runs.submit_tool_outputs_and_poll(
+RUN_FINAL_EVENTS = ("thread.run.completed", "thread.run.failed", "thread.run.cancelled",
+                    "thread.run.expired", "thread.run.incomplete")
+RUN_FINAL_STATUSES = ("completed", "failed", "cancelled", "expired", "incomplete")
+
+def collect_tool_outputs(run, chat_id):
+    tool_outputs = []
+    userid_and_values = []
+    for tool in run.required_action.submit_tool_outputs.tool_calls:
+        value_dict = json.loads(tool.function.arguments)
+        values = value_dict.get('values', [])
+        tool_outputs.append({
+            "tool_call_id": tool.id,
+            "output": tool.function.arguments
+        })
+        #отправятся на валидацию
+        userid_and_values.append({
+            "values": values,
+            "chat_id": chat_id
+        })
+    return tool_outputs, userid_and_values
+
+@timed("assistant_run")
+async def stream_run(thread_id, chat_id, additional_messages, timings, run_options=None, progress=None):
+    # Обрабатываем события run-а по мере поступления: вызовы инструментов
+    # и итоговое сообщение ассистента приходят прямо из потока, без поллинга
+    run = None
+    assistant_message = None
+    # Ценности копятся в progress, чтобы не потеряться, если попытку оборвет таймаут
+    userid_and_values = [] if progress is None else progress.setdefault('values', [])
+    started = perf_counter()
+    stream_manager = get_client().beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=ASSISTANT_ID,
+        tool_choice="required",
+        additional_messages=additional_messages,
+        **(run_options or {})
+    )
+    while stream_manager is not None:
+        next_stream_manager = None
+        async with stream_manager as stream:
+            async for event in stream:
+                if 'first_event' not in timings:
+                    timings['first_event'] = perf_counter() - started
+                if event.event == "thread.run.created" and progress is not None:
+                    # С этого момента сообщение пользователя уже в потоке
+                    progress['run_id'] = event.data.id
+                elif event.event == "thread.run.requires_action":
+                    run = event.data
+                    tool_outputs, values = collect_tool_outputs(run, chat_id)
+                    userid_and_values.extend(values)
+                    if tool_outputs:
+                        timings['tool_calls'] = perf_counter() - started
+                        next_stream_manager = get_client().beta.threads.runs.submit_tool_outputs_stream(
                             thread_id=thread_id,
                             run_id=run.id,
                             tool_outputs=tool_outputs
                         )
-                    except Exception as e:
-                        logging.error("Failed to submit tool outputs:", e)
-                else:
-                    logging.info("No tool outputs to submit.")
-                #проверяем значения на корректность и сохраняем в бд, если корректны
-                await validate_values(userid_and_values)
-            if run.status == "completed":
+                    else:
+                        logging.info("No tool outputs to submit.")
+                elif event.event == "thread.message.completed" and event.data.role == 'assistant':
+                    assistant_message = event.data
+                elif event.event in RUN_FINAL_EVENTS:
+                    run = event.data
+        stream_manager = next_stream_manager
+    timings['run'] = perf_counter() - started
+    return run, assistant_message, userid_and_values
+
+@timed("file_citations")
+async def resolve_file_names(file_ids: list[str]) -> dict:
+    names = await file_name_cache.get_many(file_ids)
+    missing = [file_id for file_id in file_ids if file_id not in names]
+    if missing:
+        # Незакэшированные файлы запрашиваем параллельно
+        results = await gather(
+            *(endpoint("files").call(lambda file_id=file_id: get_client().files.retrieve(file_id)) for file_id in missing),
+            return_exceptions=True,
+        )
+        fetched = {}
+        for file_id, result in zip(missing, results):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to retrieve file {file_id}: {result}")
+            else:
+                fetched[file_id] = result.filename
+        await file_name_cache.set_many(fetched)
+        names.update(fetched)
+    return names
+
+async def replace_file_citations(response_text: str, annotations) -> str:
+    citations = {}
+    for annotation in annotations:
+        if file_citation := getattr(annotation, "file_citation", None):
+            citations[annotation.text] = file_citation.file_id
+    if not citations:
+        return response_text
+    names = await resolve_file_names(list(dict.fromkeys(citations.values())))
+    replacements = {text: names[file_id] for text, file_id in citations.items() if file_id in names}
+    if not replacements:
+        return response_text
+    # Все цитаты заменяются за один проход по тексту
+    pattern = re.compile("|".join(re.escape(text) for text in sorted(replacements, key=len, reverse=True)))
+    response_text = pattern.sub(lambda match: replacements[match.group(0)], response_text)
+    for filename in dict.fromkeys(replacements.values()):
+        if filename not in response_text:
+            response_text += filename
+    return response_text
+
+SUMMARY_PROMPT = (
+    "Summarize this conversation between a user and a supportive assistant in a few sentences. "
+    "Keep facts about the user, their feelings, goals and open questions; drop greetings and small talk."
+)
+# Фоновые сжатия истории по chat_id
+summary_tasks = {}
+
+async def values_instructions(chat_id):
+    # Подтвержденные ценности пользователя передаются коротким additional_instructions,
+    # не попадая в историю потока
+    if not settings.USER_VALUES_CONTEXT:
+        return None
+    try:
+        # Профиль берется из кэша; после записи новых ценностей он сбрасывается
+        entries = await values_cache.get_profile(chat_id)
+    except Exception as e:
+        logging.warning(f"Failed to load values for chat {chat_id}: {e}")
+        return None
+    if not entries:
+        return None
+    values = [entry.value for entry in entries[:settings.USER_VALUES_CONTEXT_LIMIT]]
+    return "Known life values of this user: " + ", ".join(values) + "."
+
+def context_run_options() -> dict:
+    if settings.CONTEXT_MODE == "full":
+        return {}
+    options = {}
+    if settings.RUN_LAST_MESSAGES:
+        options["truncation_strategy"] = {"type": "last_messages", "last_messages": settings.RUN_LAST_MESSAGES}
+    if settings.RUN_MAX_PROMPT_TOKENS:
+        options["max_prompt_tokens"] = settings.RUN_MAX_PROMPT_TOKENS
+    return options
+
+def message_text(message) -> str:
+    return " ".join(block.text.value for block in message.content if block.type == "text")
+
+def schedule_summary(chat_id, thread_id, run):
+    if settings.CONTEXT_MODE != "summarize" or run.usage is None or chat_id in summary_tasks:
+        return
+    if run.usage.prompt_tokens < settings.SUMMARY_TRIGGER_TOKENS:
+        return
+    task = create_task(summarize_thread(chat_id, thread_id))
+    summary_tasks[chat_id] = task
+    task.add_done_callback(lambda _: summary_tasks.pop(chat_id, None))
+
+@timed("assistant_summary")
+async def summarize_thread(chat_id, thread_id):
+    # История сжимается в одно сообщение нового потока, дальше разговор идет в нем
+    try:
+        page = await endpoint("threads").call(lambda: get_client().beta.threads.messages.list(
+            thread_id=thread_id, order="desc", limit=settings.SUMMARY_MAX_MESSAGES
+        ))
+        transcript = "\n".join(f"{message.role}: {message_text(message)}" for message in reversed(page.data))
+        response = await endpoint("summary").call(lambda: get_client().chat.completions.create(
+            model=settings.SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+            max_tokens=settings.SUMMARY_MAX_TOKENS,
+        ))
+        summary = response.choices[0].message.content
+        thread = await endpoint("threads").call(lambda: get_client().beta.threads.create(
+            messages=[{"role": "assistant", "content": f"Summary of our conversation so far: {summary}"}]
+        ), idempotent=False)
+        if await thread_registry.rotate(chat_id, thread_id, thread.id) != thread.id:
+            # Поток этого чата уже сменил другой процесс
+            await delete_thread(thread.id)
+            return
+        logging.info(f"Summarized {len(page.data)} messages of chat {chat_id} into {len(summary)} chars")
+    except Exception as e:
+        count_error("assistant_summary")
+        logging.error(f"Failed to summarize thread {thread_id} for chat {chat_id}: {e}")
+
+@timed("assistant_thread")
+async def create_thread() -> str:
+    # Повтор создания мог бы оставить лишний поток, поэтому без повторов
+    thread = await endpoint("threads").call(lambda: get_client().beta.threads.create(), idempotent=False)
+    return thread.id
+
+async def delete_thread(thread_id: str):
+    await endpoint("threads").call(lambda: get_client().beta.threads.delete(thread_id))
+
+async def cancel_run(thread_id: str, run_id: str):
+    # Оборванный по таймауту run иначе держит поток занятым до истечения. Отмена асинхронная
+    # (статус "cancelling"), а новый run на потоке с активным получит 400 — ждем конечного статуса
+    try:
+        run = await get_client().beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
+        deadline = perf_counter() + settings.RUN_CANCEL_TIMEOUT
+        while run.status not in RUN_FINAL_STATUSES and perf_counter() < deadline:
+            await asyncio_sleep(0.5)
+            run = await get_client().beta.threads.runs.retrieve(run_id=run_id, thread_id=thread_id)
+        if run.status not in RUN_FINAL_STATUSES:
+            logging.warning(f"Run {run_id} is still {run.status} after {settings.RUN_CANCEL_TIMEOUT}s")
+    except OpenAIError as e:
+        logging.warning(f"Failed to cancel run {run_id}: {e}")
+
+async def get_assistant_response(chat_id, user_message: str, state: FSMContext) -> str:
+    timings = {}
+    started = perf_counter()
+    if chat_id in summary_tasks:
+        # Следующий ход должен попасть уже в новый поток
+        await shield(summary_tasks[chat_id])
+    try:
+        thread_id, instructions = await gather(
+            thread_registry.get_or_create(chat_id, create_thread, delete_thread, state),
+            values_instructions(chat_id),
+        )
+    except Exception as e:
+        count_error("assistant_thread")
+        logging.error(f"Failed to get thread for chat_id {chat_id}: {e}")
+        return FALLBACK_REPLY
+    timings['thread'] = perf_counter() - started
+    run_options = context_run_options()
+    if instructions:
+        run_options["additional_instructions"] = instructions
+    try:
+        attempt_limit = 3
+        # Сообщение пользователя добавляется в поток вместе с созданием run-а, один раз
+        additional_messages = [{"role": "user", "content": user_message}]
+        for attempt in range(attempt_limit):
+            progress = {}
+            try:
+                # Run не идемпотентен: повторы — здесь, с учетом того, создан ли уже run
+                run, assistant_message, userid_and_values = await endpoint("assistant_run").call(
+                    lambda: stream_run(thread_id, chat_id, additional_messages, timings, run_options, progress),
+                    idempotent=False,
+                )
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if progress.get('values'):
+                    enqueue_values_validation(progress['values'])
+                # Отменяем и на последней попытке: следующий ход пользователя пойдет в этот же поток
+                if 'run_id' in progress:
+                    await cancel_run(thread_id, progress['run_id'])
+                if attempt == attempt_limit - 1:
+                    raise
+                logging.warning(f"Assistant run attempt {attempt + 1} for chat {chat_id} failed: {e!r}")
+                run, assistant_message, userid_and_values = None, None, []
+            if 'run_id' in progress:
+                additional_messages = None
+            if userid_and_values:
+                #проверка и сохранение ценностей идут в фоне, не задерживая ответ
+                enqueue_values_validation(userid_and_values)
+            if run is not None and run.status == "completed" and assistant_message is not None:
                 break                
             # Если превышен лимит попыток, генерируем исключение
             elif attempt == attempt_limit - 1:
                 raise Exception("Failed to create assistant after multiple attempts")
-            await asyncio_sleep(2)
-
-        messages = await client.beta.threads.messages.list(thread_id=thread_id)
-        # Поиск ответа ассистента в сообщениях
-        for msg in messages.data:
-            if msg.role == 'assistant':
-                message_content=msg.content[0].text
-                
-                response_text = message_content.value
-                annotations = message_content.annotations
-                for index, annotation in enumerate(annotations):
-                    if file_citation := getattr(annotation, "file_citation", None):
-                        cited_file = await client.files.retrieve(file_citation.file_id) 
-                        print(annotation.text)
-                        response_text = response_text.replace(annotation.text, cited_file.filename)
-                        if not cited_file.filename in response_text:
-                            response_text += cited_file.filename
-                return await get_tts_response(response_text)
+            count_retry("assistant_run")
+            await asyncio_sleep(backoff_delay(attempt))
+
+        message_content = assistant_message.content[0].text
+        response_text = await replace_file_citations(message_content.value, message_content.annotations)
+        timings['total'] = perf_counter() - started
+        usage = ""
+        if run.usage is not None:
+            observe_tokens(run.usage.prompt_tokens, run.usage.completion_tokens)
+            usage = f", prompt_tokens={run.usage.prompt_tokens}, completion_tokens={run.usage.completion_tokens}"
+            schedule_summary(chat_id, thread_id, run)
+        logging.info(
+            f"Assistant turn for chat {chat_id}: "
+            + ", ".join(f"{stage}={elapsed:.2f}s" for stage, elapsed in timings.items())
+            + usage
+        )
+        return response_text
+    except CircuitOpenError as e:
+        logging.warning(f"Assistant unavailable for chat {chat_id}: {e}")
+        return FALLBACK_REPLY
     except Exception as e:
+        count_error("assistant_run")
         logging.error(f"Error while getting assistant response: {e}")
-        return None
+        return FALLBACK_REPLY
+
+validation_queue = None
+validation_workers = []
+# Кэш вердиктов по нормализованной строке ценности
+value_verdicts = OrderedDict()
+
+def normalize_value(value: str) -> str:
+    return ' '.join(value.lower().split())
+
+def start_validation_workers():
+    global validation_queue
+    if validation_queue is None:
+        validation_queue = Queue(maxsize=settings.VALUE_VALIDATION_QUEUE_SIZE)
+        for _ in range(settings.VALUE_VALIDATION_WORKERS):
+            validation_workers.append(create_task(validation_worker()))
+
+async def stop_validation_workers(timeout: float = 10):
+    global validation_queue
+    if validation_queue is None:
+        return
+    # Даем воркерам дообработать очередь, затем останавливаем их
+    try:
+        await wait_for(validation_queue.join(), timeout)
+    except AsyncioTimeoutError:
+        logging.warning(f"{validation_queue.qsize()} value validations dropped on shutdown")
+    for worker in validation_workers:
+        worker.cancel()
+    await gather(*validation_workers, return_exceptions=True)
+    validation_workers.clear()
+    validation_queue = None
+
+def enqueue_values_validation(userid_and_values):
+    start_validation_workers()
+    try:
+        validation_queue.put_nowait(userid_and_values)
+    except QueueFull:
+        logging.warning(f"Value validation queue is full, dropping {userid_and_values}")
 
+async def validation_worker():
+    while True:
+        userid_and_values = await validation_queue.get()
+        try:
+            await validate_values(userid_and_values)
+        finally:
+            validation_queue.task_done()
+
+def remember_verdict(key: str, is_valid: bool):
+    value_verdicts[key] = is_valid
+    value_verdicts.move_to_end(key)
+    while len(value_verdicts) > settings.VALUE_VERDICT_CACHE_SIZE:
+        value_verdicts.popitem(last=False)
+
+async def classify_life_values(values: list[str]) -> dict:
+    verdicts = {}
+    unknown = {}
+    for value in values:
+        key = normalize_value(value)
+        if not key:
+            verdicts[key] = False
+        elif key in value_verdicts:
+            value_verdicts.move_to_end(key)
+            verdicts[key] = value_verdicts[key]
+        else:
+            unknown.setdefault(key, value)
+    if not unknown:
+        return verdicts
+    try:
+        # Один запрос к модели на все новые ценности хода
+        batch_verdicts = await batch_is_life_value(list(unknown.values()))
+        for key in unknown:
+            if key in batch_verdicts:
+                remember_verdict(key, batch_verdicts[key])
+            verdicts[key] = batch_verdicts.get(key, False)
+    except Exception as e:
+        logging.error(f"Batch value validation failed, checking one by one: {e}")
+        slots = Semaphore(settings.VALUE_VALIDATION_CONCURRENCY)
+
+        async def check(value):
+            async with slots:
+                return await is_life_value(value)
+
+        results = await gather(*(check(value) for value in unknown.values()), return_exceptions=True)
+        for (key, value), result in zip(unknown.items(), results):
+            if isinstance(result, Exception):
+                # Без вердикта ценность не сохраняется и будет проверена снова в следующий раз
+                logging.error(f"Error while checking if '{value}' is a key life value: {result}")
+                verdicts[key] = False
+            else:
+                remember_verdict(key, result)
+                verdicts[key] = result
+    return verdicts
+
+@timed("value_validation")
 async def validate_values(userid_and_values):
     try:
+        values_by_chat = {}
         for item in userid_and_values:
-            for value in item['values']:
-                is_valid = await is_life_value(value)
-                if is_valid:
-                    logging.info(f"Chat ID: {item['chat_id']}, Value: {value}")
-                    #сохраняем в бд корректную жизеннную ценность
-                    await save_user_value(user_id=item['chat_id'], value=value)
-                else:
-                    logging.info(f"Value '{value}' is not a key life value for user ID {item['chat_id']}")
+            values_by_chat.setdefault(item['chat_id'], []).extend(item['values'])
+        verdicts = await classify_life_values(
+            [value for values in values_by_chat.values() for value in values]
+        )
+        #сохраняем в бд корректные жизненные ценности всех чатов пачки одной транзакцией
+        async with UnitOfWork() as uow:
+            for chat_id, values in values_by_chat.items():
+                accepted = []
+                for value in values:
+                    if verdicts.get(normalize_value(value)):
+                        if value not in accepted:
+                            accepted.append(value)
+                    else:
+                        logging.info(f"Value '{value}' is not a key life value for user ID {chat_id}")
+                if accepted:
+                    logging.info(f"Chat ID: {chat_id}, Values: {accepted}")
+                    uow.add_values(chat_id, accepted)
         logging.info("Values saved to database")
     except Exception as e:
+        count_error("value_validation")
         logging.error(f"Error while validate values: {e}")
 
+async def batch_is_life_value(values: list[str]) -> dict:
+    messages=[
+        {"role": "user", "content": "For each of the following candidate values decide whether it is a key life value. "
+                                    "Answer for every value.\n" + json.dumps(values, ensure_ascii=False)}
+    ]
+    tools = [
+        {
+            "type": "function",
+            "function": {
+                "name": "classify_life_values",
+                "description": "Report for each given value whether it is a key life value",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "verdicts": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "value": {"type": "string", "description": "The value exactly as given"},
+                                    "true_false": {
+                                        "type": "string",
+                                        "enum": ["true", "false"],
+                                        "description": """
+                                            'true' means the value is defined correctly and does not contain nonsense.
+                                            'false' means the value is determined incorrectly or the string is empty.
+                                            """,
+                                    },
+                                },
+                                "required": ["value", "true_false"],
+                            },
+                        }
+                    },
+                    "required": ["verdicts"],
+                },
+            }
+        }
+    ]
+    response = await endpoint("chat").call(lambda: get_client().chat.completions.create(
+        model="gpt-4",
+        messages=messages,
+        tools=tools,
+        tool_choice={"type": "function", "function": {"name": "classify_life_values"}}
+    ), hedge=True)
+    verdicts = {}
+    for tool_call in response.choices[0].message.tool_calls or []:
+        function_arguments = json.loads(tool_call.function.arguments)
+        for verdict in function_arguments.get('verdicts', []):
+            verdicts[normalize_value(verdict.get('value', ''))] = verdict.get('true_false') == "true"
+    return verdicts
+
 async def is_life_value(value: str) -> bool:
     messages=[
         {"role": "user", "content": f"Is '{value}' a key life value? Answer only true or false."}
@@ -170,47 +560,136 @@ async def is_life_value(value: str) -> bool:
             }
         }
     ]
-    try:
-        response = await client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            tools=tools
-        )
-        tool_calls = response.choices[0].message.tool_calls
-        if tool_calls:
-            for tool_call in tool_calls:
-                if tool_call.function:
-                    function_arguments = json.loads(tool_call.function.arguments)
-                    true_false_value = function_arguments.get('true_false')
-        return true_false_value in ["true"]
-    except Exception as e:
-        logging.error(f"Error while checking if '{value}' is a key life value: {e}")
-        return False
+    # Ошибки пробрасываются: вызывающий не должен запомнить сбой как ответ "false"
+    response = await endpoint("chat").call(lambda: get_client().chat.completions.create(
+        model="gpt-4",
+        messages=messages,
+        tools=tools
+    ), hedge=True)
+    true_false_value = None
+    tool_calls = response.choices[0].message.tool_calls
+    if tool_calls:
+        for tool_call in tool_calls:
+            if tool_call.function:
+                function_arguments = json.loads(tool_call.function.arguments)
+                true_false_value = function_arguments.get('true_false')
+    return true_false_value in ["true"]
+
 
+def tts_cache_key(text: str) -> str:
+    return make_tts_key(TTS_MODEL, TTS_VOICE, text)
 
 async def get_tts_response(text: str) -> bytes:
+    cache_key = tts_cache_key(text)
+    if cached := await tts_cache.get_audio(cache_key):
+        return cached
     try:
-        response = await client.audio.speech.create(
-            model="tts-1",
-            voice="alloy",
-            input=text
-        )
+        async with timed("tts"):
+            response = await endpoint("tts").call(lambda: get_client().audio.speech.create(
+                model=TTS_MODEL,
+                voice=TTS_VOICE,
+                input=text
+            ), hedge=True)
         audio_data = response.content
         ogg_opus_data = await convert_to_ogg_opus(audio_data)
+        await tts_cache.set_audio(cache_key, ogg_opus_data)
         return ogg_opus_data
-    except OpenAIError as e:
+    except Exception as e:
+        # Ошибки API, перекодирования и пула — ответ уйдет текстом
+        count_error("tts")
         logging.error(f"Error while tts: {e}")
         return None
 
-async def transcribe_audio_file(unique_filename):
+async def stream_tts_chunk(text: str) -> bytes:
+    # PCM приходит кусками по мере генерации и сразу кодируется в Opus
+    encoder = OpusStreamEncoder()
     try:
-        with open(unique_filename, "rb") as audio_file:
-            transcription = await client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
-            return transcription.text
-    except OpenAIError as e:
+        async with get_client().audio.speech.with_streaming_response.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+            input=text,
+            response_format="pcm"
+        ) as response:
+            async for pcm in response.iter_bytes(8192):
+                await to_thread(encoder.feed, pcm)
+        return await to_thread(encoder.finish)
+    except Exception:
+        encoder.close()
+        raise
+
+@timed("tts_stream_chunk")
+async def synthesize_tts_chunk(text: str) -> bytes:
+    cache_key = tts_cache_key(text)
+    if cached := await tts_cache.get_audio(cache_key):
+        return cached
+    try:
+        ogg_opus_data = await endpoint("tts_stream").call(lambda: stream_tts_chunk(text))
+        await tts_cache.set_audio(cache_key, ogg_opus_data)
+        return ogg_opus_data
+    except Exception as e:
+        count_error("tts_stream_chunk")
+        logging.error(f"Error while streaming tts: {e}")
+        return None
+
+async def stream_tts_response(text: str):
+    chunks = split_into_sentences(text, settings.TTS_FIRST_CHUNK_CHARS, settings.TTS_CHUNK_CHARS)
+    started = perf_counter()
+    # Следующие куски синтезируются, пока предыдущие отправляются
+    slots = Semaphore(settings.TTS_STREAM_LOOKAHEAD)
+
+    async def synthesize(chunk):
+        async with slots:
+            return await synthesize_tts_chunk(chunk)
+
+    tasks = [create_task(synthesize(chunk)) for chunk in chunks]
+    try:
+        for index, task in enumerate(tasks):
+            audio_data = await task
+            if index == 0:
+                logging.info(f"TTS stream: first of {len(tasks)} chunks ready in {perf_counter() - started:.2f}s")
+            if not audio_data:
+                # Кусок не синтезировался: остаток ответа (с этим куском) уходит одним текстом
+                yield " ".join(chunks[index:]), None
+                return
+            yield chunks[index], audio_data
+        logging.info(f"TTS stream: all {len(tasks)} chunks ready in {perf_counter() - started:.2f}s")
+    finally:
+        for task in tasks:
+            task.cancel()
+
+transcription_backend = None
+
+def get_transcription_backend():
+    # Создается при первом голосовом: локальной модели незачем загружаться при старте
+    global transcription_backend
+    if transcription_backend is None:
+        transcription_backend = create_transcription_backend(get_client())
+    return transcription_backend
+
+async def transcribe_speech_chunks(backend, chunks) -> str:
+    slots = Semaphore(settings.TRANSCRIBE_CONCURRENCY)
+
+    async def transcribe_chunk(index, chunk):
+        async with slots:
+            return await endpoint("transcription").call(lambda: backend.transcribe(chunk, f"speech_{index}.ogg"))
+
+    # Куски режутся по паузам, поэтому тексты просто склеиваются по порядку
+    texts = await gather(*(transcribe_chunk(index, chunk) for index, chunk in enumerate(chunks)))
+    return " ".join(text.strip() for text in texts if text and text.strip())
+
+async def transcribe_audio_file(audio_data: bytes, filename: str = "voice.ogg"):
+    try:
+        backend = get_transcription_backend()
+        chunks = await prepare_speech(audio_data, backend.needs_encoded) if settings.TRANSCRIBE_PREPROCESS else None
+        if chunks == []:
+            logging.info("Voice note contains no speech, skipping transcription")
+            return ""
+        async with timed("whisper_transcription"):
+            if chunks is None:
+                return await endpoint("transcription").call(lambda: backend.transcribe(audio_data, filename))
+            return await transcribe_speech_chunks(backend, chunks)
+    except Exception as e:
+        count_error("transcription")
         logging.error(f"Error while transcribe audio file: {e}")
         return None
     
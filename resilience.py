@@ -0,0 +1,239 @@
+import logging
+
+from asyncio import FIRST_COMPLETED, create_task, wait, wait_for, sleep as asyncio_sleep
+from asyncio import TimeoutError as AsyncioTimeoutError
+from collections import deque
+from dataclasses import asdict, dataclass
+from inspect import isawaitable
+from random import uniform
+from time import monotonic, perf_counter
+from typing import Awaitable, Callable, Optional
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from config import settings
+from metrics import count_retry, register_collector
+
+# Ошибки, после которых запрос имеет смысл повторить; на остальные (400, 401, 404...)
+# сервис ответил осмысленно, и повтор ничего не даст
+RETRYABLE_ERRORS = (AsyncioTimeoutError, APIConnectionError, RateLimitError, InternalServerError)
+# Верхняя граница таймаута по эндпоинтам, пока нет статистики задержек
+ENDPOINT_TIMEOUTS = {
+    "chat": 30.0,
+    "vision": 30.0,
+    "tts": 30.0,
+    "tts_stream": 30.0,
+    "transcription": 60.0,
+    "assistant_run": 120.0,
+    "threads": 15.0,
+    "files": 15.0,
+    "summary": 60.0,
+}
+DEFAULT_TIMEOUT = 60.0
+# Длительность этих вызовов растет с размером запроса (длина текста, длина голосового,
+# число раундов инструментов): общий квантиль по коротким вызовам обрывал бы длинные,
+# поэтому у них фиксированный таймаут и задержки не копятся
+SIZE_DEPENDENT_ENDPOINTS = {"tts", "tts_stream", "transcription", "assistant_run"}
+# Сколько замеров нужно, чтобы доверять квантилям
+MIN_SAMPLES = 20
+
+
+def backoff_delay(attempt: int) -> float:
+    # Экспоненциальная задержка с полным jitter: повторы разных клиентов не совпадают по времени
+    return uniform(0, min(settings.RESILIENCE_BACKOFF_MAX, settings.RESILIENCE_BACKOFF_BASE * 2 ** attempt))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class LatencyWindow:
+    def __init__(self, size: int):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, fraction: float) -> Optional[float]:
+        if len(self.samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN:
+            # После паузы пропускаем один пробный запрос
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.warning(f"Circuit for {self.name} opened after {self.failures} consecutive failures")
+            self.state = self.OPEN
+            self.opened_at = monotonic()
+
+
+@dataclass
+class EndpointStats:
+    calls: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    retries: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    short_circuits: int = 0
+    fallbacks: int = 0
+
+
+class Endpoint:
+    # Таймаут выводится из наблюдаемых задержек (p99 * множитель), повторы — с экспоненциальной
+    # задержкой и полным jitter, hedge-запрос уходит, если первый не ответил за p95
+    def __init__(self, name: str, max_timeout: float, adaptive: bool = True):
+        self.name = name
+        self.max_timeout = max_timeout
+        self.adaptive = adaptive
+        self.window = LatencyWindow(settings.RESILIENCE_LATENCY_WINDOW)
+        self.breaker = CircuitBreaker(name, settings.BREAKER_FAILURE_THRESHOLD, settings.BREAKER_RESET_TIMEOUT)
+        self.stats = EndpointStats()
+
+    def timeout(self) -> float:
+        if not self.adaptive:
+            return self.max_timeout
+        p99 = self.window.quantile(0.99)
+        if p99 is None:
+            return self.max_timeout
+        return min(max(p99 * settings.RESILIENCE_TIMEOUT_MULTIPLIER, settings.RESILIENCE_MIN_TIMEOUT), self.max_timeout)
+
+    async def call(
+        self,
+        factory: Callable[[], Awaitable],
+        idempotent: bool = True,
+        hedge: bool = False,
+        fallback: Optional[Callable] = None,
+    ):
+        # factory создает новую корутину на каждую попытку; fallback вызывается, когда
+        # цепь разомкнута или попытки кончились (без него ошибка пробрасывается)
+        if not settings.RESILIENCE_ENABLED:
+            return await factory()
+        self.stats.calls += 1
+        if not self.breaker.allow():
+            self.stats.short_circuits += 1
+            return await self._fallback(fallback, CircuitOpenError(f"{self.name} circuit is open"))
+        attempts = settings.RESILIENCE_MAX_ATTEMPTS if idempotent else 1
+        error = None
+        for attempt in range(attempts):
+            started = perf_counter()
+            try:
+                if hedge and settings.RESILIENCE_HEDGE:
+                    result = await wait_for(self._hedged(factory), self.timeout())
+                else:
+                    result = await wait_for(factory(), self.timeout())
+            except RETRYABLE_ERRORS as e:
+                error = e
+                self.stats.failures += 1
+                if isinstance(e, AsyncioTimeoutError):
+                    self.stats.timeouts += 1
+                    error = AsyncioTimeoutError(f"{self.name} timed out after {perf_counter() - started:.1f}s")
+                self.breaker.failure()
+                if attempt + 1 == attempts or self.breaker.state == CircuitBreaker.OPEN:
+                    break
+                self.stats.retries += 1
+                count_retry(self.name)
+                await asyncio_sleep(backoff_delay(attempt))
+            except Exception:
+                # Сервис ответил (пусть и ошибкой) — он жив
+                self.breaker.success()
+                raise
+            else:
+                if self.adaptive:
+                    self.window.add(perf_counter() - started)
+                self.breaker.success()
+                return result
+        logging.warning(f"{self.name} failed after {attempt + 1} attempt(s): {error!r}")
+        return await self._fallback(fallback, error)
+
+    async def _fallback(self, fallback, error):
+        if fallback is None:
+            raise error
+        self.stats.fallbacks += 1
+        result = fallback()
+        if isawaitable(result):
+            result = await result
+        return result
+
+    async def _hedged(self, factory):
+        delay = self.window.quantile(settings.RESILIENCE_HEDGE_QUANTILE)
+        first = create_task(factory())
+        tasks = {first}
+        try:
+            if delay is not None:
+                done, _ = await wait(tasks, timeout=delay)
+                if not done:
+                    self.stats.hedges += 1
+                    tasks.add(create_task(factory()))
+            error = None
+            while tasks:
+                done, tasks = await wait(tasks, return_when=FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.stats.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+endpoints = {}
+
+
+def endpoint(name: str) -> Endpoint:
+    if name not in endpoints:
+        endpoints[name] = Endpoint(
+            name, ENDPOINT_TIMEOUTS.get(name, DEFAULT_TIMEOUT), adaptive=name not in SIZE_DEPENDENT_ENDPOINTS
+        )
+    return endpoints[name]
+
+
+def _collect():
+    return {
+        ("endpoint", name): {
+            **asdict(item.stats),
+            "breaker_state": item.breaker.state,
+            "timeout_seconds": item.timeout(),
+        }
+        for name, item in endpoints.items()
+    }
+
+
+register_collector("bot_openai_resilience", _collect, "OpenAI call resilience (breaker_state: 0 closed, 1 half-open, 2 open)")
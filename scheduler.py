@@ -0,0 +1,194 @@
+import logging
+
+from asyncio import Semaphore, create_task, get_running_loop, sleep as asyncio_sleep
+from collections import deque
+from dataclasses import dataclass, field
+from time import perf_counter
+
+from aiogram.fsm.context import FSMContext
+
+from config import settings
+from openai_client import get_assistant_response
+from metrics import observe, register_collector
+
+TURN_LOCK_PREFIX = "turn:lock:"
+
+
+class TurnLockError(Exception):
+    pass
+
+
+@dataclass
+class PendingTurn:
+    user_id: int
+    state: FSMContext
+    coalesce: bool
+    enqueued_at: float
+    texts: list = field(default_factory=list)
+    futures: list = field(default_factory=list)
+
+
+@dataclass
+class SchedulerStats:
+    queued: int = 0
+    in_flight: int = 0
+    turns: int = 0
+    coalesced: int = 0
+    failed: int = 0
+    lock_timeouts: int = 0
+    queue_wait_total: float = 0.0
+    queue_wait_max: float = 0.0
+    run_time_total: float = 0.0
+    run_time_max: float = 0.0
+
+
+class TurnScheduler:
+    # Ходы одного чата выполняются строго по очереди (на одном thread_id не бывает
+    # двух активных run-ов), а общее число запросов к ассистенту ограничено глобально
+    # и на пользователя. Между процессами (режим webhook) ходы одного чата разводит блокировка в Redis
+    def __init__(self, max_concurrency: int, per_user_concurrency: int, coalesce: bool, coalesce_window: float,
+                 lock_timeout: float, lock_wait: float):
+        self.max_concurrency = max_concurrency
+        self.per_user_concurrency = per_user_concurrency
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+        self.redis = None
+        self.stats = SchedulerStats()
+        self._chats = {}
+        self._workers = {}
+        self._global_slots = None
+        self._user_slots = {}
+        self._user_active = {}
+
+    def setup(self, redis):
+        self.redis = redis
+
+    async def submit(self, chat_id, user_id, text: str, state: FSMContext, coalesce: bool = True):
+        # Возвращает текст ответа; для сообщений, склеенных с предыдущим, возвращает None
+        future = get_running_loop().create_future()
+        queue = self._chats.setdefault(chat_id, deque())
+        if coalesce and self.coalesce and queue and queue[-1].coalesce:
+            queue[-1].texts.append(text)
+            queue[-1].futures.append(future)
+            self.stats.coalesced += 1
+        else:
+            turn = PendingTurn(user_id=user_id, state=state, coalesce=coalesce, enqueued_at=perf_counter())
+            turn.texts.append(text)
+            turn.futures.append(future)
+            queue.append(turn)
+            self.stats.queued += 1
+        if chat_id not in self._workers:
+            self._workers[chat_id] = create_task(self._drain(chat_id))
+        return await future
+
+    async def _drain(self, chat_id):
+        queue = self._chats[chat_id]
+        try:
+            while queue:
+                if self.coalesce_window:
+                    # Даем быстро идущим подряд сообщениям собраться в один ход
+                    await asyncio_sleep(self.coalesce_window)
+                turn = queue.popleft()
+                await self._run_turn(chat_id, turn)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                del self._chats[chat_id]
+
+    async def _run_turn(self, chat_id, turn: PendingTurn):
+        if self._global_slots is None:
+            self._global_slots = Semaphore(self.max_concurrency)
+        user_slots = self._user_slots.setdefault(turn.user_id, Semaphore(self.per_user_concurrency))
+        self._user_active[turn.user_id] = self._user_active.get(turn.user_id, 0) + 1
+        lock = None
+        response_text = error = None
+        try:
+            try:
+                # Блокировку берем до слотов, чтобы ожидание другого процесса не занимало слот
+                lock = await self._lock_chat(chat_id)
+            except TurnLockError as e:
+                # Без блокировки run мог бы совпасть с run-ом другого процесса на том же потоке
+                error = e
+                self.stats.queued -= 1
+                self.stats.failed += 1
+            if error is None:
+                response_text, error = await self._execute(chat_id, turn, user_slots)
+        finally:
+            await self._unlock_chat(chat_id, lock)
+            self._user_active[turn.user_id] -= 1
+            if not self._user_active[turn.user_id]:
+                del self._user_active[turn.user_id]
+                del self._user_slots[turn.user_id]
+        first, *rest = turn.futures
+        if not first.done():
+            if error is not None:
+                first.set_exception(error)
+            else:
+                first.set_result(response_text)
+        for future in rest:
+            if not future.done():
+                future.set_result(None)
+
+    async def _execute(self, chat_id, turn: PendingTurn, user_slots):
+        async with user_slots, self._global_slots:
+            started = perf_counter()
+            queue_wait = started - turn.enqueued_at
+            self.stats.queued -= 1
+            self.stats.in_flight += 1
+            self.stats.queue_wait_total += queue_wait
+            self.stats.queue_wait_max = max(self.stats.queue_wait_max, queue_wait)
+            observe("turn_queue_wait", queue_wait)
+            try:
+                response_text = await get_assistant_response(chat_id, "\n".join(turn.texts), turn.state)
+                error = None
+            except Exception as e:
+                response_text = None
+                error = e
+                self.stats.failed += 1
+            finally:
+                run_time = perf_counter() - started
+                self.stats.in_flight -= 1
+                self.stats.turns += 1
+                self.stats.run_time_total += run_time
+                self.stats.run_time_max = max(self.stats.run_time_max, run_time)
+                observe("turn_run", run_time)
+        logging.info(
+            f"Turn for chat {chat_id}: {len(turn.texts)} message(s), "
+            f"queue wait {queue_wait:.2f}s, run {run_time:.2f}s"
+        )
+        return response_text, error
+
+    async def _lock_chat(self, chat_id):
+        if self.redis is None:
+            return None
+        lock = self.redis.lock(TURN_LOCK_PREFIX + str(chat_id), timeout=self.lock_timeout, blocking_timeout=self.lock_wait)
+        try:
+            acquired = await lock.acquire()
+        except Exception as e:
+            raise TurnLockError(f"Turn lock for chat {chat_id} failed: {e}") from e
+        if not acquired:
+            self.stats.lock_timeouts += 1
+            raise TurnLockError(f"Turn lock for chat {chat_id} not acquired in {self.lock_wait}s")
+        return lock
+
+    async def _unlock_chat(self, chat_id, lock):
+        if lock is None:
+            return
+        try:
+            await lock.release()
+        except Exception as e:
+            # Ход длиннее lock_timeout: блокировка уже истекла
+            logging.warning(f"Turn lock for chat {chat_id} release failed: {e}")
+
+
+turn_scheduler = TurnScheduler(
+    max_concurrency=settings.TURN_MAX_CONCURRENCY,
+    per_user_concurrency=settings.TURN_PER_USER_CONCURRENCY,
+    coalesce=settings.TURN_COALESCE,
+    coalesce_window=settings.TURN_COALESCE_WINDOW,
+    lock_timeout=settings.TURN_LOCK_TIMEOUT,
+    lock_wait=settings.TURN_LOCK_WAIT,
+)
+register_collector("bot_turn_scheduler", lambda: turn_scheduler.stats, "Assistant turn scheduler")
@@ -0,0 +1,233 @@
+import logging
+
+from asyncio import Event, Semaphore, create_task, get_running_loop, sleep as asyncio_sleep, wait_for
+from asyncio import CancelledError, TimeoutError as AsyncioTimeoutError
+from collections import deque
+from dataclasses import dataclass, field
+from heapq import heappop, heappush
+from itertools import count
+from time import monotonic
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import settings
+from metrics import observe, register_collector
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        # Через сколько секунд будет доступен токен
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        # retry_after от Telegram: ни одного токена до истечения паузы
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class SendJob:
+    call: Callable[[], Awaitable]
+    priority: int
+    future: object
+    enqueued_at: float = field(default_factory=monotonic)
+    attempts: int = 0
+
+
+@dataclass
+class SendQueueStats:
+    queued: int = 0
+    in_flight: int = 0
+    sent: int = 0
+    failed: int = 0
+    throttled: int = 0
+    retries: int = 0
+    queue_delay_total: float = 0.0
+    queue_delay_max: float = 0.0
+
+
+class SendQueue:
+    # Все исходящие сообщения идут через одну очередь: общий и поканальный token bucket
+    # по лимитам Telegram, retry_after из 429 соблюдается, короткие ответы обгоняют длинные
+    # (порядок внутри одного чата сохраняется), а при переполнении send() ждет места
+    def __init__(self, global_rate: float, global_burst: int, chat_rate: float, chat_burst: int,
+                 max_queue: int, short_bytes: int, max_retries: int):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_queue = max_queue
+        self.short_bytes = short_bytes
+        self.max_retries = max_retries
+        self.stats = SendQueueStats()
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        self._buckets = {}
+        self._busy = set()
+        self._ready = []
+        self._delayed = []
+        self._seq = count()
+        self._tasks = set()
+        self._wakeup = None
+        self._slots = None
+        self._dispatcher = None
+
+    def start(self):
+        if self._dispatcher is None:
+            self._wakeup = Event()
+            self._slots = Semaphore(self.max_queue)
+            self._dispatcher = create_task(self._dispatch())
+
+    async def stop(self, timeout: float = 10):
+        if self._dispatcher is None:
+            return
+        # Даем отправить то, что уже в очереди
+        deadline = monotonic() + timeout
+        while (self._chats or self._tasks) and monotonic() < deadline:
+            await asyncio_sleep(0.05)
+        if self._chats:
+            logging.warning(f"Dropping {self.stats.queued} unsent Telegram messages")
+        self._dispatcher.cancel()
+        try:
+            await self._dispatcher
+        except CancelledError:
+            pass
+        self._dispatcher = None
+
+    async def send(self, chat_id, call: Callable[[], Awaitable], size: int = 0):
+        # call — фабрика корутины (на повтор после 429 вызывается еще раз); возвращает ее результат
+        self.start()
+        async with self._slots:
+            job = SendJob(
+                call=call,
+                priority=0 if size <= self.short_bytes else 1,
+                future=get_running_loop().create_future(),
+            )
+            queue = self._chats.setdefault(chat_id, deque())
+            queue.append(job)
+            self.stats.queued += 1
+            if len(queue) == 1 and chat_id not in self._busy:
+                self._schedule(chat_id)
+            return await job.future
+
+    def _schedule(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        delay = bucket.delay()
+        if delay:
+            heappush(self._delayed, (monotonic() + delay, next(self._seq), chat_id))
+        else:
+            heappush(self._ready, (self._chats[chat_id][0].priority, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        while True:
+            now = monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heappop(self._delayed)
+                self._schedule(chat_id)
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await wait_for(self._wakeup.wait(), timeout)
+                except AsyncioTimeoutError:
+                    pass
+                continue
+            wait = self._global.delay()
+            if wait:
+                # Пока ждем общий лимит, может прийти ответ с более высоким приоритетом
+                await asyncio_sleep(wait)
+                continue
+            _, _, chat_id = heappop(self._ready)
+            job = self._chats[chat_id].popleft()
+            self._global.take()
+            self._buckets[chat_id].take()
+            self._busy.add(chat_id)
+            task = create_task(self._send(chat_id, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, chat_id, job: SendJob):
+        self.stats.queued -= 1
+        try:
+            if job.future.done():
+                return
+            if not job.attempts:
+                delay = monotonic() - job.enqueued_at
+                self.stats.queue_delay_total += delay
+                self.stats.queue_delay_max = max(self.stats.queue_delay_max, delay)
+                observe("telegram_send_queue", delay)
+            self.stats.in_flight += 1
+            try:
+                result = await job.call()
+            except TelegramRetryAfter as e:
+                self.stats.throttled += 1
+                self._buckets[chat_id].pause(e.retry_after)
+                if job.attempts < self.max_retries:
+                    logging.warning(f"Telegram rate limit for chat {chat_id}, retry after {e.retry_after}s")
+                    job.attempts += 1
+                    self.stats.retries += 1
+                    self.stats.queued += 1
+                    self._chats[chat_id].appendleft(job)
+                elif not job.future.done():
+                    self.stats.failed += 1
+                    job.future.set_exception(e)
+            except Exception as e:
+                self.stats.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.stats.sent += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.stats.in_flight -= 1
+        finally:
+            self._busy.discard(chat_id)
+            if self._chats[chat_id]:
+                self._schedule(chat_id)
+            else:
+                del self._chats[chat_id]
+                self._prune_buckets()
+
+    def _prune_buckets(self):
+        # Bucket простаивающего чата можно забыть, как только он снова полон
+        if len(self._buckets) <= settings.SEND_CHAT_BUCKETS:
+            return
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._chats and bucket.full()]:
+            del self._buckets[chat_id]
+
+
+send_queue = SendQueue(
+    global_rate=settings.SEND_GLOBAL_RATE,
+    global_burst=settings.SEND_GLOBAL_BURST,
+    chat_rate=settings.SEND_CHAT_RATE,
+    chat_burst=settings.SEND_CHAT_BURST,
+    max_queue=settings.SEND_MAX_QUEUE,
+    short_bytes=settings.SEND_SHORT_BYTES,
+    max_retries=settings.SEND_MAX_RETRIES,
+)
+register_collector("bot_send_queue", lambda: send_queue.stats, "Outbound Telegram send queue")
@@ -1,26 +1,306 @@
 import base64
 import logging
+import multiprocessing
+import re
 
+import numpy as np
+
+from asyncio import Semaphore, get_running_loop, to_thread
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from io import BytesIO
-from soundfile import SoundFile, write
+from time import perf_counter
+from PIL import Image
+from soundfile import SoundFile
+
+from config import settings
+from metrics import timed, register_collector
+
+# Размер блока (в сэмплах) для потокового декодирования/кодирования
+TRANSCODE_BLOCK_SIZE = 16384
+# Формат, который отдает OpenAI TTS при response_format="pcm"
+TTS_PCM_SAMPLE_RATE = 24000
+
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+IMAGE_MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp', 'GIF': 'image/gif'}
+
+
+@dataclass
+class TranscodeStats:
+    queue_depth: int = 0
+    in_flight: int = 0
+    completed: int = 0
+    failed: int = 0
+    encode_time_total: float = 0.0
+    encode_time_max: float = 0.0
+
+
+@dataclass
+class SpeechStats:
+    queue_depth: int = 0
+    in_flight: int = 0
+    notes: int = 0
+    silent_notes: int = 0
+    failed: int = 0
+    chunks: int = 0
+    input_bytes: int = 0
+    upload_bytes: int = 0
+    input_seconds: float = 0.0
+    speech_seconds: float = 0.0
+
+
+transcode_stats = TranscodeStats()
+register_collector("bot_opus_transcode", lambda: transcode_stats, "Opus transcode pool")
+speech_stats = SpeechStats()
+register_collector("bot_speech_prepare", lambda: speech_stats, "Voice note preprocessing")
+_transcode_pool = None
+_transcode_slots = None
+# Подготовка голосовых — в своем пуле: длинная запись не должна задерживать кодирование TTS-ответов
+_speech_pool = None
+_speech_slots = None
+
+
+def transcode_to_ogg_opus(audio_data: bytes) -> tuple[bytes, float]:
+    # Выполняется в дочернем процессе: декодируем и кодируем блоками,
+    # не держа весь клип в одном float32 буфере
+    started = perf_counter()
+    with BytesIO(audio_data) as audio_file, BytesIO() as ogg_opus_file:
+        with SoundFile(audio_file) as sound:
+            with SoundFile(ogg_opus_file, mode='w', samplerate=sound.samplerate, channels=sound.channels,
+                           format='OGG', subtype='OPUS') as ogg_opus:
+                for block in sound.blocks(blocksize=TRANSCODE_BLOCK_SIZE, dtype='float32'):
+                    ogg_opus.write(block)
+        return ogg_opus_file.getvalue(), perf_counter() - started
+
+
+def _pool_context():
+    # Пулы создаются лениво внутри работающего цикла: fork скопировал бы в рабочие процессы
+    # его состояние, открытые сокеты и блокировки потоков. Рабочие порождаются от чистого forkserver
+    return multiprocessing.get_context("forkserver")
+
+
+def _get_transcode_pool():
+    global _transcode_pool, _transcode_slots
+    if _transcode_pool is None:
+        _transcode_pool = ProcessPoolExecutor(max_workers=settings.OPUS_WORKERS, mp_context=_pool_context())
+        _transcode_slots = Semaphore(settings.OPUS_MAX_PENDING)
+    return _transcode_pool, _transcode_slots
+
+
+def _get_speech_pool():
+    global _speech_pool, _speech_slots
+    if _speech_pool is None:
+        _speech_pool = ProcessPoolExecutor(max_workers=settings.SPEECH_WORKERS, mp_context=_pool_context())
+        _speech_slots = Semaphore(settings.SPEECH_MAX_PENDING)
+    return _speech_pool, _speech_slots
 
+
+def shutdown_transcode_pool():
+    global _transcode_pool, _transcode_slots, _speech_pool, _speech_slots
+    if _transcode_pool is not None:
+        _transcode_pool.shutdown(wait=True)
+        _transcode_pool = None
+        _transcode_slots = None
+    if _speech_pool is not None:
+        _speech_pool.shutdown(wait=True)
+        _speech_pool = None
+        _speech_slots = None
+
+
+@timed("opus_transcode")
 async def convert_to_ogg_opus(audio_data: bytes) -> bytes:
+    pool, slots = _get_transcode_pool()
+    # Ограничиваем число задач в пуле: лишние ждут здесь, а не копятся в очереди executor-а
+    waiting = True
+    transcode_stats.queue_depth += 1
     try:
-        with BytesIO(audio_data) as audio_file:
-            with SoundFile(audio_file) as sound:
-                audio_data = sound.read(dtype='float32')
-                sample_rate = sound.samplerate
-
-        with BytesIO() as ogg_opus_file:
-            write(ogg_opus_file, audio_data, sample_rate, format='OGG', subtype='OPUS')
-            return ogg_opus_file.getvalue()
+        async with slots:
+            transcode_stats.queue_depth -= 1
+            waiting = False
+            transcode_stats.in_flight += 1
+            try:
+                ogg_opus_data, encode_time = await get_running_loop().run_in_executor(
+                    pool, transcode_to_ogg_opus, audio_data
+                )
+            finally:
+                transcode_stats.in_flight -= 1
+        transcode_stats.completed += 1
+        transcode_stats.encode_time_total += encode_time
+        transcode_stats.encode_time_max = max(transcode_stats.encode_time_max, encode_time)
+        return ogg_opus_data
     except Exception as e:
+        transcode_stats.failed += 1
         logging.error(f"Exception occurred: {e}")
+    finally:
+        if waiting:
+            transcode_stats.queue_depth -= 1
+
+class OpusStreamEncoder:
+    # Инкрементальный кодер: принимает куски 16-bit PCM по мере прихода и пишет их в OGG/Opus
+    def __init__(self, samplerate: int = TTS_PCM_SAMPLE_RATE):
+        self._buffer = BytesIO()
+        self._sound = SoundFile(self._buffer, mode='w', samplerate=samplerate, channels=1,
+                                format='OGG', subtype='OPUS')
+        self._remainder = b''
+
+    def feed(self, pcm: bytes):
+        pcm = self._remainder + pcm
+        usable = len(pcm) - len(pcm) % 2
+        self._remainder = pcm[usable:]
+        if usable:
+            self._sound.write(np.frombuffer(pcm[:usable], dtype='<i2'))
+
+    def finish(self) -> bytes:
+        self._sound.close()
+        data = self._buffer.getvalue()
+        self._buffer.close()
+        return data
+
+    def close(self):
+        if not self._sound.closed:
+            self._sound.close()
+        self._buffer.close()
+
+
+def split_into_sentences(text: str, first_chunk_chars: int, chunk_chars: int) -> list[str]:
+    # Группируем предложения в куски; первый делаем короче, чтобы быстрее отправить первое аудио
+    chunks = []
+    current = ''
+    for sentence in SENTENCE_END.split(text.strip()):
+        limit = first_chunk_chars if not chunks else chunk_chars
+        if current and len(current) + len(sentence) + 1 > limit:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+def prepare_image(image_data: bytes, max_side: int, quality: int) -> tuple[str, str]:
+    # Уменьшаем изображение до max_side по большей стороне и перекодируем в JPEG;
+    # небольшие картинки поддерживаемых форматов отправляем как есть
+    with Image.open(BytesIO(image_data)) as image:
+        mime_type = IMAGE_MIME_TYPES.get(image.format)
+        if mime_type and max(image.size) <= max_side:
+            return base64.b64encode(image_data).decode('utf-8'), mime_type
+        image.thumbnail((max_side, max_side))
+        with BytesIO() as jpeg_file:
+            image.convert('RGB').save(jpeg_file, format='JPEG', quality=quality, optimize=True)
+            return base64.b64encode(jpeg_file.getvalue()).decode('utf-8'), 'image/jpeg'
 
-async def encode_image(image_path):
+@timed("image_prepare")
+async def encode_image(image_data: bytes, max_side: int, quality: int):
+    # Декодирование, ресайз и base64 выполняются вне event loop
     try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        return await to_thread(prepare_image, image_data, max_side, quality)
     except Exception as e:
         logging.error(f"Exception occurred: {e}")
+        return None, None
 
+
+def decode_mono(audio_data: bytes) -> tuple[np.ndarray, int]:
+    with BytesIO(audio_data) as audio_file, SoundFile(audio_file) as sound:
+        samples = sound.read(dtype='float32', always_2d=True)
+        return samples.mean(axis=1, dtype=np.float32), sound.samplerate
+
+def resample(samples: np.ndarray, samplerate: int, target_rate: int) -> np.ndarray:
+    if samplerate == target_rate:
+        return samples
+    if samplerate % target_rate == 0:
+        # Кратная частота (48 кГц у голосовых Telegram): усреднение соседних сэмплов
+        # работает и как простой фильтр от наложения спектров
+        factor = samplerate // target_rate
+        usable = len(samples) - len(samples) % factor
+        return samples[:usable].reshape(-1, factor).mean(axis=1, dtype=np.float32)
+    positions = np.arange(int(len(samples) * target_rate / samplerate)) * (samplerate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+def frame_energy_db(samples: np.ndarray, frame: int) -> np.ndarray:
+    count = len(samples) // frame
+    frames = samples[:count * frame].reshape(count, frame)
+    return 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+
+def find_split_points(energy: np.ndarray, max_frames: int, min_frames: int) -> list[int]:
+    # Длинную запись режем в самом тихом кадре между min и max длиной куска;
+    # при min_frames=0 точка могла остаться на месте и цикл не заканчивался
+    min_frames = max(min_frames, 1)
+    points = []
+    start = 0
+    while len(energy) - start > max_frames:
+        window = energy[start + min_frames:start + max_frames]
+        start = start + min_frames + int(np.argmin(window))
+        points.append(start)
+    return points
+
+def encode_speech_chunk(samples: np.ndarray, samplerate: int) -> bytes:
+    with BytesIO() as ogg_opus_file:
+        with SoundFile(ogg_opus_file, mode='w', samplerate=samplerate, channels=1,
+                       format='OGG', subtype='OPUS') as ogg_opus:
+            ogg_opus.write(samples)
+        return ogg_opus_file.getvalue()
+
+def split_speech(audio_data: bytes, sample_rate: int, frame_ms: int, threshold_db: float, margin_db: float,
+                 padding_ms: int, max_chunk_seconds: float, min_chunk_seconds: float, encode: bool):
+    # Выполняется в пуле процессов: одно декодирование, моно 16 кГц, обрезка тишины по энергии
+    # кадров и разбиение на куски по паузам. Возвращает (куски, длительность записи, длительность речи);
+    # кусок — OGG/Opus или float32 PCM, если encode=False
+    samples, samplerate = decode_mono(audio_data)
+    duration = len(samples) / samplerate
+    samples = resample(samples, samplerate, sample_rate)
+    frame = sample_rate * frame_ms // 1000
+    energy = frame_energy_db(samples, frame)
+    if not len(energy):
+        return [], duration, 0.0
+    voiced = np.flatnonzero(energy > max(threshold_db, energy.max() - margin_db))
+    if not len(voiced):
+        return [], duration, 0.0
+    padding = padding_ms // frame_ms
+    first = max(voiced[0] - padding, 0)
+    last = min(voiced[-1] + padding + 1, len(energy))
+    energy = energy[first:last]
+    samples = samples[first * frame:last * frame]
+    max_frames = max(int(max_chunk_seconds * 1000 / frame_ms), 2)
+    min_frames = min(max(int(min_chunk_seconds * 1000 / frame_ms), 1), max_frames - 1)
+    bounds = [0] + [point * frame for point in find_split_points(energy, max_frames, min_frames)] + [len(samples)]
+    chunks = [samples[start:end] for start, end in zip(bounds, bounds[1:])]
+    if encode:
+        chunks = [encode_speech_chunk(chunk, sample_rate) for chunk in chunks]
+    return chunks, duration, len(samples) / sample_rate
+
+@timed("speech_prepare")
+async def prepare_speech(audio_data: bytes, encode: bool = True):
+    # None — подготовка не удалась и нужно отправить исходный файл, [] — в записи нет речи
+    pool, slots = _get_speech_pool()
+    waiting = True
+    speech_stats.queue_depth += 1
+    try:
+        async with slots:
+            speech_stats.queue_depth -= 1
+            waiting = False
+            speech_stats.in_flight += 1
+            try:
+                chunks, duration, speech_duration = await get_running_loop().run_in_executor(
+                    pool, split_speech, audio_data, settings.TRANSCRIBE_SAMPLE_RATE, settings.VAD_FRAME_MS,
+                    settings.VAD_THRESHOLD_DB, settings.VAD_PEAK_MARGIN_DB, settings.VAD_PADDING_MS,
+                    settings.TRANSCRIBE_CHUNK_SECONDS, settings.TRANSCRIBE_MIN_CHUNK_SECONDS, encode,
+                )
+            finally:
+                speech_stats.in_flight -= 1
+    except Exception as e:
+        speech_stats.failed += 1
+        logging.error(f"Failed to prepare voice note: {e}")
+        return None
+    finally:
+        if waiting:
+            speech_stats.queue_depth -= 1
+    speech_stats.notes += 1
+    speech_stats.silent_notes += not chunks
+    speech_stats.chunks += len(chunks)
+    speech_stats.input_bytes += len(audio_data)
+    speech_stats.input_seconds += duration
+    speech_stats.speech_seconds += speech_duration
+    if encode:
+        speech_stats.upload_bytes += sum(len(chunk) for chunk in chunks)
+    return chunks
@@ -1,11 +1,13 @@
 import logging
-from openai import AsyncOpenAI
 from config import settings
 from asyncio import run as asyncio_run
+from http_clients import create_openai_client
+from kb_sync import sync_knowledge_base
 
 async def initialize_assistant()-> str:
+    # Клиент создается только на время вызова: импорт модуля не требует OPENAI_API_KEY
+    client = create_openai_client()
     try:
-        client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
         assistant = await client.beta.assistants.create(
             name="Chat Assistant",
             instructions = """
@@ -39,43 +41,15 @@ async def initialize_assistant()-> str:
         return assistant.id
     except Exception as e:
         logging.error(f"Exception occurred: {e}")
+    finally:
+        await client.close()
 
 
 
-async def update_assistant(id=settings.OPENAI_API_KEY):
+async def update_assistant(id=settings.ASSISTANT_ID):
+    # Загрузка документов и настройка file_search — в kb_sync.py: повторный запуск
+    # загружает только изменившиеся файлы и не дублирует инструкции и инструменты
     try:
-        client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-
-        vector_store = await client.beta.vector_stores.create(name="anxiety")
-
-        file_paths = ["anxiety.docx"]
-        
-        file_streams = [open(path, "rb") for path in file_paths]
-
-        await client.beta.vector_stores.file_batches.upload_and_poll(
-        vector_store_id=vector_store.id, files=file_streams
-        )
-
-        [file_stream.close() for file_stream in file_streams]
-
-        assistant_details = await client.beta.assistants.retrieve(id)
-
-        current_instructions = assistant_details.instructions
-        additional_instructions="""
-            Always look for information using the `file_search` tool before giving an answer. 
-            If `file_search` does not return relevant information, proceed with your own knowledge.
-        """
-        updated_instructions = f"{current_instructions}\n\n{additional_instructions}"
-        
-        current_tools = assistant_details.tools
-        new_tools = [{"type": "file_search",}]        
-        updated_tools = current_tools + new_tools
-
-        await client.beta.assistants.update(
-            assistant_id=id,
-            tools=updated_tools,
-            tool_resources={"file_search": {"vector_store_ids": [vector_store.id],}},
-            instructions=updated_instructions,
-        )
+        await sync_knowledge_base(assistant_id=id)
     except Exception as e:
-        logging.error(f"Exception occurred: {e}")
\ No newline at end of file
+        logging.error(f"Exception occurred: {e}")
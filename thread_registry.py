@@ -0,0 +1,204 @@
+import logging
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic, time
+from typing import Awaitable, Callable, Optional
+
+from aiogram.fsm.context import FSMContext
+
+from config import settings
+from metrics import register_collector
+
+THREADS_KEY = "assistant:threads"
+TURNS_KEY = "assistant:thread_turns"
+
+# Счетчик ходов и текущий поток чата за один запрос к Redis
+TOUCH_SCRIPT = """
+local turns = redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+return {redis.call('HGET', KEYS[1], ARGV[1]), turns}
+"""
+# Замена потока только если его не успел заменить другой процесс
+ROTATE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if not current or current == ARGV[2] or string.sub(current, 1, #ARGV[2] + 1) == ARGV[2] .. '@' then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return ARGV[3]
+end
+return current
+"""
+
+
+def encode_entry(thread_id: str, created_at: int) -> str:
+    return f"{thread_id}@{created_at}"
+
+
+def decode_entry(entry) -> tuple[str, int]:
+    if isinstance(entry, bytes):
+        entry = entry.decode('utf-8')
+    thread_id, _, created_at = entry.partition("@")
+    return thread_id, int(created_at or 0)
+
+
+@dataclass
+class ThreadRegistryStats:
+    lookups: int = 0
+    local_hits: int = 0
+    redis_hits: int = 0
+    migrated: int = 0
+    created: int = 0
+    lost_races: int = 0
+    rotated: int = 0
+    redis_ops: int = 0
+
+    @property
+    def redis_ops_per_lookup(self) -> float:
+        return self.redis_ops / self.lookups if self.lookups else 0.0
+
+
+class ThreadRegistry:
+    # chat_id -> thread_id ассистента. Раньше thread_id лежал в данных FSM и каждое
+    # сообщение читало их целиком; теперь это хэш в Redis с локальным LRU поверх.
+    # Локальная запись живет local_ttl секунд: поток мог сменить другой процесс
+    def __init__(self, max_entries: int, ttl: int, max_turns: int, local_ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.local_ttl = local_ttl
+        self.redis = None
+        self.stats = ThreadRegistryStats()
+        self._entries = OrderedDict()
+        self._touch = None
+        self._rotate = None
+
+    def setup(self, redis):
+        self.redis = redis
+        self._touch = redis.register_script(TOUCH_SCRIPT)
+        self._rotate = redis.register_script(ROTATE_SCRIPT)
+
+    async def get_or_create(
+        self,
+        chat_id,
+        create: Callable[[], Awaitable[str]],
+        delete: Optional[Callable[[str], Awaitable[None]]] = None,
+        state: Optional[FSMContext] = None,
+    ) -> str:
+        self.stats.lookups += 1
+        field = str(chat_id)
+        entry, turns = await self._lookup(field, state)
+        if entry is None:
+            return await self._create(field, create, delete)
+        if self._expired(entry, turns):
+            thread_id = await create()
+            current = await self.rotate(chat_id, entry[0], thread_id)
+            if current != thread_id:
+                # Поток уже сменил другой процесс: созданный нами не нужен
+                self.stats.lost_races += 1
+                await self._discard(thread_id, delete)
+            return current
+        return entry[0]
+
+    async def rotate(self, chat_id, old_thread_id: str, new_thread_id: str) -> str:
+        # Новый поток для длинного разговора; старый остается в OpenAI как история
+        field = str(chat_id)
+        new_entry = (new_thread_id, int(time()))
+        if self.redis is not None:
+            self.stats.redis_ops += 1
+            current = await self._rotate(
+                keys=[THREADS_KEY, TURNS_KEY],
+                args=[field, old_thread_id, encode_entry(*new_entry)],
+            )
+            if current is not None:
+                new_entry = decode_entry(current)
+        self._remember(field, new_entry)
+        if new_entry[0] == new_thread_id:
+            self.stats.rotated += 1
+            logging.info(f"Rotated assistant thread for chat {chat_id}: {old_thread_id} -> {new_thread_id}")
+        return new_entry[0]
+
+    async def _lookup(self, field: str, state: Optional[FSMContext]):
+        cached = self._entries.get(field)
+        entry = cached[0] if cached is not None else None
+        if cached is not None and not self.max_turns and (self.redis is None or cached[1] > monotonic()):
+            self._entries.move_to_end(field)
+            self.stats.local_hits += 1
+            return entry, 0
+        if self.redis is None:
+            return entry, 0
+        self.stats.redis_ops += 1
+        if self.max_turns:
+            # Счет ходов заодно возвращает актуальный поток, если его сменил другой процесс
+            raw, turns = await self._touch(keys=[THREADS_KEY, TURNS_KEY], args=[field])
+        else:
+            raw, turns = await self.redis.hget(THREADS_KEY, field), 0
+        if raw is not None:
+            entry = decode_entry(raw)
+            self.stats.redis_hits += 1
+            self._remember(field, entry)
+            return entry, turns
+        if state is not None:
+            entry = await self._migrate(field, state)
+        return entry, turns
+
+    async def _migrate(self, field: str, state: FSMContext):
+        # Потоки, созданные до появления реестра, хранились в данных FSM под ключом str(chat_id)
+        self.stats.redis_ops += 1
+        data = await state.get_data()
+        thread_id = data.get(field)
+        if not thread_id:
+            return None
+        entry = await self._store(field, (thread_id, int(time())))
+        self.stats.migrated += 1
+        self.stats.redis_ops += 1
+        await state.set_data({key: value for key, value in data.items() if key != field})
+        return entry
+
+    async def _create(self, field: str, create, delete) -> str:
+        thread_id = await create()
+        entry = await self._store(field, (thread_id, int(time())))
+        if entry[0] == thread_id:
+            self.stats.created += 1
+        else:
+            # Первые сообщения чата пришли в два процесса одновременно: используем поток победителя
+            self.stats.lost_races += 1
+            await self._discard(thread_id, delete)
+        return entry[0]
+
+    async def _discard(self, thread_id: str, delete):
+        if delete is None:
+            return
+        try:
+            await delete(thread_id)
+        except Exception as e:
+            logging.warning(f"Failed to delete duplicate thread {thread_id}: {e}")
+
+    async def _store(self, field: str, entry: tuple[str, int]) -> tuple[str, int]:
+        if self.redis is not None:
+            self.stats.redis_ops += 1
+            if not await self.redis.hsetnx(THREADS_KEY, field, encode_entry(*entry)):
+                self.stats.redis_ops += 1
+                entry = decode_entry(await self.redis.hget(THREADS_KEY, field))
+        self._remember(field, entry)
+        return entry
+
+    def _expired(self, entry: tuple[str, int], turns: int) -> bool:
+        if self.max_turns and turns > self.max_turns:
+            return True
+        return bool(self.ttl and entry[1] and entry[1] + self.ttl < time())
+
+    def _remember(self, field: str, entry: tuple[str, int]):
+        self._entries[field] = (entry, monotonic() + self.local_ttl)
+        self._entries.move_to_end(field)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+thread_registry = ThreadRegistry(
+    max_entries=settings.THREAD_CACHE_SIZE,
+    ttl=settings.THREAD_TTL,
+    max_turns=settings.THREAD_MAX_TURNS,
+    # При сжатии истории поток меняется каждые несколько ходов — сверяемся с Redis на каждом
+    local_ttl=0 if settings.CONTEXT_MODE == "summarize" else settings.THREAD_LOCAL_TTL,
+)
+register_collector("bot_thread_registry", lambda: thread_registry.stats, "Assistant thread registry")
@@ -0,0 +1,64 @@
+from asyncio import Semaphore, to_thread
+from importlib import import_module
+from io import BytesIO
+
+from config import settings
+
+
+class TranscriptionBackend:
+    # Распознает один кусок речи. needs_encoded=True — кусок приходит как OGG/Opus байты,
+    # False — как float32 PCM 16 кГц (локальным моделям не нужно лишнее кодирование)
+    needs_encoded = True
+
+    async def transcribe(self, audio, filename: str = "speech.ogg") -> str:
+        raise NotImplementedError
+
+
+class OpenAITranscriptionBackend(TranscriptionBackend):
+    def __init__(self, client, model: str):
+        self.client = client
+        self.model = model
+
+    async def transcribe(self, audio, filename: str = "speech.ogg") -> str:
+        # Whisper принимает (имя файла, байты) — расширение нужно для определения формата
+        transcription = await self.client.audio.transcriptions.create(model=self.model, file=(filename, audio))
+        return transcription.text
+
+
+class FasterWhisperBackend(TranscriptionBackend):
+    # Локальная модель на CPU (пакет faster-whisper, ставится отдельно)
+    needs_encoded = False
+
+    def __init__(self, model_size: str, compute_type: str, workers: int):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise RuntimeError("TRANSCRIBE_BACKEND=faster_whisper requires the faster-whisper package") from e
+        self.model = WhisperModel(model_size, device="cpu", compute_type=compute_type, num_workers=workers)
+        self.workers = workers
+        self._slots = None
+
+    def _transcribe(self, audio) -> str:
+        if isinstance(audio, bytes):
+            audio = BytesIO(audio)
+        segments, _ = self.model.transcribe(audio, beam_size=1)
+        return " ".join(segment.text.strip() for segment in segments)
+
+    async def transcribe(self, audio, filename: str = "speech.ogg") -> str:
+        if self._slots is None:
+            self._slots = Semaphore(self.workers)
+        async with self._slots:
+            return await to_thread(self._transcribe, audio)
+
+
+def create_transcription_backend(client) -> TranscriptionBackend:
+    name = settings.TRANSCRIBE_BACKEND
+    if name == "openai":
+        return OpenAITranscriptionBackend(client, settings.TRANSCRIBE_MODEL)
+    if name == "faster_whisper":
+        return FasterWhisperBackend(
+            settings.LOCAL_WHISPER_MODEL, settings.LOCAL_WHISPER_COMPUTE_TYPE, settings.LOCAL_TRANSCRIBE_WORKERS
+        )
+    # Свой бэкенд: "package.module:ClassName", конструктор без аргументов
+    module_name, _, class_name = name.partition(":")
+    return getattr(import_module(module_name), class_name)()
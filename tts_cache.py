@@ -0,0 +1,138 @@
+import logging
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from hashlib import sha256
+from time import monotonic
+from typing import Optional
+
+from config import settings
+from metrics import register_collector
+
+AUDIO_PREFIX = "tts:audio:"
+FILE_ID_PREFIX = "tts:file_id:"
+
+
+def make_tts_key(model: str, voice: str, text: str) -> str:
+    return sha256(f"{model}\0{voice}\0{text}".encode('utf-8')).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    local_hits: int = 0
+    redis_hits: int = 0
+    misses: int = 0
+    file_id_hits: int = 0
+    file_id_misses: int = 0
+    evictions: int = 0
+
+
+class LocalLRU:
+    # In-process LRU, ограниченный суммарным размером значений, с TTL на запись
+    def __init__(self, max_bytes: int, ttl: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < monotonic():
+            self._pop(key)
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value) -> int:
+        if len(value) > self.max_bytes:
+            return 0
+        if key in self._items:
+            self._pop(key)
+        self._items[key] = (value, monotonic() + self.ttl)
+        self.size += len(value)
+        evicted = 0
+        while self.size > self.max_bytes:
+            self._pop(next(iter(self._items)))
+            evicted += 1
+        return evicted
+
+    def _pop(self, key):
+        value, _ = self._items.pop(key)
+        self.size -= len(value)
+
+
+class TTSCache:
+    def __init__(self, max_bytes: int, ttl: int, max_entry_bytes: int):
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.local = LocalLRU(max_bytes, ttl)
+        self.redis = None
+        self.stats = CacheStats()
+
+    def setup(self, redis):
+        # Второй уровень — тот же Redis, что используется для RedisStorage
+        self.redis = redis
+
+    async def get_audio(self, key: str) -> Optional[bytes]:
+        audio_data = self.local.get(AUDIO_PREFIX + key)
+        if audio_data is not None:
+            self.stats.local_hits += 1
+            return audio_data
+        audio_data = await self._redis_get(AUDIO_PREFIX + key)
+        if audio_data is not None:
+            self.stats.redis_hits += 1
+            self.stats.evictions += self.local.set(AUDIO_PREFIX + key, audio_data)
+            return audio_data
+        self.stats.misses += 1
+        return None
+
+    async def set_audio(self, key: str, audio_data: bytes):
+        if not audio_data or len(audio_data) > self.max_entry_bytes:
+            return
+        self.stats.evictions += self.local.set(AUDIO_PREFIX + key, audio_data)
+        await self._redis_set(AUDIO_PREFIX + key, audio_data)
+
+    async def get_file_id(self, key: str) -> Optional[str]:
+        file_id = self.local.get(FILE_ID_PREFIX + key)
+        if file_id is None:
+            file_id = await self._redis_get(FILE_ID_PREFIX + key)
+            if file_id is not None:
+                file_id = file_id.decode('utf-8')
+                self.local.set(FILE_ID_PREFIX + key, file_id)
+        if file_id is None:
+            self.stats.file_id_misses += 1
+        else:
+            self.stats.file_id_hits += 1
+        return file_id
+
+    async def set_file_id(self, key: str, file_id: str):
+        self.local.set(FILE_ID_PREFIX + key, file_id)
+        await self._redis_set(FILE_ID_PREFIX + key, file_id)
+
+    async def _redis_get(self, key):
+        if self.redis is None:
+            return None
+        try:
+            return await self.redis.get(key)
+        except Exception as e:
+            logging.warning(f"TTS cache read failed: {e}")
+            return None
+
+    async def _redis_set(self, key, value):
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(key, value, ex=self.ttl)
+        except Exception as e:
+            logging.warning(f"TTS cache write failed: {e}")
+
+
+tts_cache = TTSCache(
+    max_bytes=settings.TTS_CACHE_LOCAL_MAX_BYTES,
+    ttl=settings.TTS_CACHE_TTL,
+    max_entry_bytes=settings.TTS_CACHE_MAX_ENTRY_BYTES,
+)
+register_collector("bot_tts_cache", lambda: tts_cache.stats, "TTS cache")
@@ -0,0 +1,261 @@
+import argparse
+import csv
+import json
+import logging
+import sys
+
+from asyncio import run as asyncio_run
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from time import monotonic
+from typing import Optional
+
+from config import settings
+from database import dispose_engine, get_top_values, get_user_value_profile, iter_user_values, values_written_hooks
+from metrics import register_collector
+
+PROFILE_PREFIX = "values:profile:"
+GENERATION_PREFIX = "values:gen:"
+TOP_KEY_PREFIX = "values:top:"
+
+# Профиль из базы кладется в Redis, только если за время чтения его не сбросили:
+# invalidate увеличивает поколение пользователя
+SET_IF_CURRENT_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[3] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+INVALIDATE_SCRIPT = """
+for i = 1, #KEYS, 2 do
+    redis.call('DEL', KEYS[i])
+    redis.call('INCR', KEYS[i + 1])
+    redis.call('EXPIRE', KEYS[i + 1], ARGV[1])
+end
+return #KEYS / 2
+"""
+
+
+@dataclass
+class ValueEntry:
+    value: str
+    first_seen: date
+    last_seen: date
+
+
+@dataclass
+class TopValue:
+    value: str
+    users: int
+    first_seen: date
+    last_seen: date
+
+
+@dataclass
+class ValuesCacheStats:
+    local_hits: int = 0
+    redis_hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+
+
+def encode_rows(rows) -> str:
+    # Последние два поля строки — даты первого и последнего упоминания
+    return json.dumps([[*row[:-2], row[-2].isoformat(), row[-1].isoformat()] for row in rows], ensure_ascii=False)
+
+
+def decode_rows(data) -> list:
+    return [[*row[:-2], date.fromisoformat(row[-2]), date.fromisoformat(row[-1])] for row in json.loads(data)]
+
+
+class ValuesProfileCache:
+    # Профили пользователей: локальный LRU (короткий TTL) поверх Redis (длинный TTL) поверх базы.
+    # UnitOfWork.commit сразу сбрасывает профиль записанных пользователей (через values_written_hooks);
+    # топ ценностей по всем пользователям только живет VALUES_TOP_TTL — сбрасывать его на каждую запись незачем
+    def __init__(self, max_entries: int, ttl: int, local_ttl: float, top_ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.top_ttl = top_ttl
+        self.redis = None
+        self._set_if_current = None
+        self._invalidate = None
+        self.stats = ValuesCacheStats()
+        self._profiles = OrderedDict()
+        self._top = {}
+
+    def setup(self, redis):
+        self.redis = redis
+        self._set_if_current = redis.register_script(SET_IF_CURRENT_SCRIPT)
+        self._invalidate = redis.register_script(INVALIDATE_SCRIPT)
+
+    async def get_profile(self, user_id: int) -> list:
+        cached = self._profiles.get(user_id)
+        if cached is not None and cached[0] > monotonic():
+            self._profiles.move_to_end(user_id)
+            self.stats.local_hits += 1
+            return cached[1]
+        rows = await self._redis_get(PROFILE_PREFIX + str(user_id))
+        current = True
+        if rows is not None:
+            self.stats.redis_hits += 1
+        else:
+            self.stats.misses += 1
+            generation = await self._redis_get_raw(GENERATION_PREFIX + str(user_id))
+            rows = await get_user_value_profile(user_id)
+            current = await self._redis_set_if_current(user_id, rows, generation)
+        entries = [ValueEntry(*row) for row in rows]
+        if current:
+            self._remember(user_id, entries)
+        return entries
+
+    async def top_values(self, limit: int) -> list:
+        cached = self._top.get(limit)
+        if cached is not None and cached[0] > monotonic():
+            self.stats.local_hits += 1
+            return cached[1]
+        key = TOP_KEY_PREFIX + str(limit)
+        rows = await self._redis_get(key)
+        if rows is not None:
+            self.stats.redis_hits += 1
+        else:
+            self.stats.misses += 1
+            rows = await get_top_values(limit)
+            await self._redis_set(key, rows, self.top_ttl)
+        top = [TopValue(*row) for row in rows]
+        self._top[limit] = (monotonic() + min(self.local_ttl, self.top_ttl), top)
+        return top
+
+    async def invalidate(self, user_ids):
+        for user_id in user_ids:
+            self._profiles.pop(user_id, None)
+        self.stats.invalidations += len(user_ids)
+        if self.redis is not None and user_ids:
+            keys = []
+            for user_id in user_ids:
+                keys += [PROFILE_PREFIX + str(user_id), GENERATION_PREFIX + str(user_id)]
+            try:
+                await self._invalidate(keys=keys, args=[self.ttl])
+            except Exception as e:
+                logging.warning(f"Values cache invalidation failed: {e}")
+
+    async def _redis_get(self, key: str) -> Optional[list]:
+        data = await self._redis_get_raw(key)
+        return None if data is None else decode_rows(data)
+
+    async def _redis_get_raw(self, key: str):
+        if self.redis is None:
+            return None
+        try:
+            return await self.redis.get(key)
+        except Exception as e:
+            logging.warning(f"Values cache read failed: {e}")
+            return None
+
+    async def _redis_set(self, key: str, rows: list, ttl: int):
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(key, encode_rows(rows), ex=ttl)
+        except Exception as e:
+            logging.warning(f"Values cache write failed: {e}")
+
+    async def _redis_set_if_current(self, user_id: int, rows: list, generation) -> bool:
+        # False — профиль сбросили, пока мы читали базу: прочитанное могло устареть, не кэшируем
+        if self.redis is None:
+            return True
+        try:
+            return bool(await self._set_if_current(
+                keys=[PROFILE_PREFIX + str(user_id), GENERATION_PREFIX + str(user_id)],
+                args=[encode_rows(rows), self.ttl, generation or ""],
+            ))
+        except Exception as e:
+            logging.warning(f"Values cache write failed: {e}")
+            return True
+
+    def _remember(self, user_id: int, entries: list):
+        self._profiles[user_id] = (monotonic() + self.local_ttl, entries)
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_entries:
+            self._profiles.popitem(last=False)
+
+
+def format_profile(entries: list) -> str:
+    if not entries:
+        return "I haven't noticed any of your life values yet. Tell me more about what matters to you."
+    lines = ["Here is what I know about your life values:"]
+    for entry in entries:
+        if entry.first_seen == entry.last_seen:
+            lines.append(f"• {entry.value} (mentioned {entry.last_seen:%d.%m.%Y})")
+        else:
+            lines.append(f"• {entry.value} (since {entry.first_seen:%d.%m.%Y}, last mentioned {entry.last_seen:%d.%m.%Y})")
+    return "\n".join(lines)
+
+
+async def export_values(output, fmt: str, user_id: Optional[int] = None) -> int:
+    # Пишет строки по мере чтения курсора; в памяти не больше одной пачки
+    exported = 0
+    writer = csv.writer(output) if fmt == "csv" else None
+    if writer is not None:
+        writer.writerow(["user_id", "value", "first_seen_date", "last_seen_date"])
+    async for batch in iter_user_values(settings.VALUES_EXPORT_BATCH, user_id):
+        for row_user_id, value, first_seen, last_seen in batch:
+            if writer is not None:
+                writer.writerow([row_user_id, value, first_seen.isoformat(), last_seen.isoformat()])
+            else:
+                output.write(json.dumps({
+                    "user_id": row_user_id,
+                    "value": value,
+                    "first_seen_date": first_seen.isoformat(),
+                    "last_seen_date": last_seen.isoformat(),
+                }, ensure_ascii=False) + "\n")
+        exported += len(batch)
+    return exported
+
+
+values_cache = ValuesProfileCache(
+    max_entries=settings.VALUES_CACHE_SIZE,
+    ttl=settings.VALUES_CACHE_TTL,
+    local_ttl=settings.VALUES_LOCAL_TTL,
+    top_ttl=settings.VALUES_TOP_TTL,
+)
+values_written_hooks.append(values_cache.invalidate)
+register_collector("bot_values_cache", lambda: values_cache.stats, "User values profile cache")
+
+
+async def run_export(args):
+    if args.output == "-":
+        exported = await export_values(sys.stdout, args.format, args.user_id)
+    else:
+        with open(args.output, "w", newline="", encoding="utf-8") as output:
+            exported = await export_values(output, args.format, args.user_id)
+    logging.info(f"Exported {exported} user values")
+
+
+async def run_top(args):
+    for item in await values_cache.top_values(args.limit):
+        print(f"{item.users:8} {item.value} ({item.first_seen:%d.%m.%Y} - {item.last_seen:%d.%m.%Y})")
+
+
+async def main(args):
+    try:
+        await args.command(args)
+    finally:
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Read side of user_values")
+    commands = parser.add_subparsers(required=True)
+    export_parser = commands.add_parser("export", help="stream user_values to CSV or JSONL")
+    export_parser.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    export_parser.add_argument("--output", default="-", help="file path, '-' for stdout")
+    export_parser.add_argument("--user-id", type=int, help="export a single user")
+    export_parser.set_defaults(command=run_export)
+    top_parser = commands.add_parser("top", help="most common values across users")
+    top_parser.add_argument("--limit", type=int, default=20)
+    top_parser.set_defaults(command=run_top)
+    asyncio_run(main(parser.parse_args()))